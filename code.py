@@ -8,8 +8,15 @@ This version includes Favorites functionality and Tap-Dance feature for extended
 """
 
 import os
+import sys
+import gc
 import time
 import json
+import array
+import asyncio
+import binascii
+import supervisor
+from adafruit_ticks import ticks_add, ticks_diff
 import displayio
 import terminalio
 from adafruit_display_shapes.rect import Rect
@@ -19,98 +26,811 @@ from adafruit_macropad import MacroPad
 # CONFIGURABLES ------------------------
 
 MACRO_FOLDER = '/macros'
+MACRO_EXTENSIONS = ('.py', '.mpy', '.json')  # Files in MACRO_FOLDER that are apps
 MENU_ITEMS = 5  # Number of menu items to display (odd number)
 FAVORITES_FILE = '/favorites.json'
+FAVORITES_SAVE_DELAY = 2.0  # Seconds after the last change before favorites are written to flash
 TAP_DANCE_TIMEOUT = 0.3  # Time window for double tap (in seconds)
 HOLD_TIMEOUT = 0.5  # Time threshold for long press (in seconds)
+MAX_LOADED_APPS = 3  # Macro sets kept in RAM at once (least recently used are dropped)
+IDLE_BACKOFF_AFTER = 1.0  # Seconds without input before the main loop starts slowing down
+IDLE_MIN_SLEEP = 0.001  # First main loop sleep once idle (in seconds), doubled each pass...
+IDLE_MAX_SLEEP = 0.02  # ...up to this, which bounds the extra input latency while idle
+MACRO_CACHE_FILE = '/macros.cache'  # Compiled macro sets, reused while files are unchanged
+MACRO_CACHE_HEADER = b'macros.cache 6\n'  # Bump when the compiled format changes
+PROBE_SAMPLES = 256  # Timing samples kept for the probe summary (see Probes)
+LOW_MEMORY_THRESHOLD = 16384  # Free heap bytes below which only the current app stays loaded
+SHOW_MEMORY = False  # Show the app's heap footprint and free heap (in KB) in the title bar
+FRAGMENT_MIN_BYTES = 15  # Shortest repeated piece of compiled code shared via OP_CALL (3 per step)
+REPEAT_DELAY = 0.3  # Seconds a repeat key is held before it starts repeating
+REPEAT_INTERVAL = 0.02  # Seconds between repeats, and between merged mouse motion reports
+REPEAT_MAX_SPEED = 8  # Repeats speed up to this many times their starting rate...
+REPEAT_RAMP = 1.5  # ...over this many seconds of repeating...
+REPEAT_CURVE = 2  # ...following this power curve (1 is linear, higher starts gentler)
+ENCODER_FAST_RATE = 15  # Encoder detents per second above which app bindings are scaled up...
+ENCODER_MAX_SCALE = 4  # ...in proportion to the speed, up to this many steps per detent
+DISPLAY_MAX_FPS = 30  # Most display refreshes per second; changes in between are combined
+LED_FPS = 60  # Most LED animation frames per second
+LED_FRAME_BUDGET = 0.004  # Seconds of rendering per frame; keys not reached catch up next frame
+LED_BRIGHTNESS = 1.0  # Scales every key color (0.0 to 1.0)
+LED_GAMMA = 2.2  # Gamma curve for fades, so they look even to the eye
+LED_FADE = 0.25  # Seconds for a released key, or a new app's colors, to fade in
+LED_RIPPLE = 96  # Highlight (0-255) a press lends the keys next to it
+LED_IDLE_AFTER = 30.0  # Seconds without input before the app's idle effect starts
+LED_IDLE_EFFECT = 'none'  # Idle effect for apps without an 'idle' entry: 'none', 'breathe' or 'off'
+LED_BREATHE_PERIOD = 4.0  # Seconds per breath of the 'breathe' idle effect
+TYPING_DELAY = 0.0  # Seconds between typed characters; raise if the host drops characters
 
 # CLASSES AND FUNCTIONS ----------------
 
 class App:
-    def __init__(self, appdata, filename, folder=''):
-        self.name = appdata['name']
-        self.macros = appdata['macros']
+    def __init__(self, name, filename, folder='', stat=None, cache_offset=None):
+        self.name = name
+        self.macros = None  # Loaded on first switch(), see load()
         self.filename = filename
         self.folder = folder
+        self.stat = stat  # (size, mtime) of the macro file when indexed
+        self.cache_offset = cache_offset  # Position of this app's entry in MACRO_CACHE_FILE
+        self.parent = None  # Folder containing this app
+        self.index = 0  # Position among parent.apps
+        self.footprint = None  # Heap bytes taken by the loaded macros, once measured
+        self.encoder = None  # (counterclockwise, clockwise) sequences if the app binds the encoder
+        self.idle = None  # The app's LED idle effect, or None for LED_IDLE_EFFECT
+
+    def load(self):
+        if self.macros is None:
+            # Measure the heap the macros take, and if the heap runs out
+            # drop every other app and try once more before giving up
+            start = probes.start()
+            gc.collect()
+            free = gc.mem_free()
+            try:
+                self.read()
+            except MemoryError:
+                self.macros = None
+                free_memory(self)
+                free = gc.mem_free()
+                try:
+                    self.read()
+                except MemoryError:
+                    print("Not enough memory for", self.filename)
+                    self.macros = []
+            gc.collect()
+            self.footprint = max(0, free - gc.mem_free())
+            print("Loaded %s: %d bytes, %d free" % (self.filename, self.footprint, gc.mem_free()))
+            probes.stop(PROBE_LOAD, start)
+        # Keep loaded_apps in least-recently-used order and drop the oldest,
+        # or in low-memory mode the heaviest, until within limits
+        if self in loaded_apps:
+            loaded_apps.remove(self)
+        loaded_apps.append(self)
+        while len(loaded_apps) > MAX_LOADED_APPS or (len(loaded_apps) > 1 and low_memory()):
+            if len(loaded_apps) > MAX_LOADED_APPS:
+                victim = loaded_apps[0]
+            else:
+                victim = max(loaded_apps[:-1], key=lambda app: app.footprint or 0)
+            loaded_apps.remove(victim)
+            victim.unload()
+            start = probes.start()
+            gc.collect()
+            probes.stop(PROBE_GC, start)
+
+    def read(self):
+        if self.cache_offset is not None:
+            try:
+                macros, self.encoder, self.idle = read_cached_macros(self)
+                self.macros = intern_macros(self.name, macros)
+                return
+            except (OSError, ValueError, KeyError, IndexError, TypeError) as err:
+                print("Cache entry for", self.filename, "unusable:", repr(err))
+                self.cache_offset = None
+        try:
+            if self.filename.endswith('.json'):
+                read_json_app(self)
+            else:
+                self.import_module()
+            if self.idle is not None and self.idle not in LED_IDLE_EFFECTS:
+                raise ValueError('unknown idle effect: ' + repr(self.idle))
+            write_cached_macros(self)
+            self.macros = intern_macros(self.name, self.macros)
+        except (SyntaxError, ImportError, AttributeError, KeyError, NameError,
+                IndexError, TypeError, ValueError, OSError) as err:
+            print("ERROR in", self.filename)
+            import traceback
+            traceback.print_exception(err, err, err.__traceback__)
+            self.macros = []
+
+    def import_module(self):
+        module_name = self.folder + '/' + file_stem(self.filename)
+        try:
+            app = __import__(module_name).app
+            self.name = app['name']
+            if self.name == 'Favorites':
+                # Favorites sequences are app commands, not HID actions
+                self.macros = app['macros']
+            else:
+                self.macros = compile_macros(app['macros'])
+                self.encoder = compile_encoder(app.get('encoder'))
+            self.idle = app.get('idle')
+        finally:
+            # Only the compiled form is kept; let the source literals be freed
+            sys.modules.pop(module_name, None)
+
+    def unload(self):
+        if self.macros is not None:
+            release_macros(self.name, self.macros)
+        self.macros = None
+        self.encoder = None
+        sys.modules.pop(self.folder + '/' + file_stem(self.filename), None)
 
     def switch(self):
-        group[13].text = self.name
+        # Only labels and LEDs that differ from what is showing are touched,
+        # and the display and LEDs are updated only if something changed
+        global hid_in_use
+        self.load()
+        refresh = False
+        title = self.name
+        if SHOW_MEMORY:
+            title = '%s %dK/%dK' % (self.name, self.footprint // 1024, gc.mem_free() // 1024)
+        if group[13].text != title:
+            group[13].text = title
+            refresh = True
         for i in range(12):
             if i < len(self.macros):
-                macropad.pixels[i] = self.macros[i][0]
-                group[i].text = self.macros[i][1]
+                color, text = self.macros[i][0], self.macros[i][1]
             else:
-                macropad.pixels[i] = 0
-                group[i].text = ''
-        macropad.keyboard.release_all()
-        macropad.consumer_control.release()
-        macropad.mouse.release_all()
-        macropad.stop_tone()
-        macropad.pixels.show()
-        macropad.display.refresh()
+                color, text = 0, ''
+            if leds.base[i] != color:
+                leds.fade_to(i, color)
+            if group[i].text != text:
+                group[i].text = text
+                refresh = True
+        cancel_macros()
+        for tap_dance in tap_dances:
+            tap_dance.reset()
+        if hid_in_use:
+            output.release_all()
+            macropad.stop_tone()
+            hid_in_use = False
+        leds.idle_effect = self.idle or LED_IDLE_EFFECT
+        if refresh:
+            request_refresh()
+
+def low_memory():
+    return gc.mem_free() < LOW_MEMORY_THRESHOLD
+
+def free_memory(keep):
+    # Unload every app but keep, e.g. when keep didn't fit in the heap
+    for app in loaded_apps[:]:
+        if app is not keep:
+            loaded_apps.remove(app)
+            app.unload()
+    gc.collect()
+
+class Folder:
+    # A node of the macro tree. items holds Apps and Folders in menu order;
+    # apps holds only the Apps, which is what the encoder steps through.
+    def __init__(self, name, path, parent=None):
+        self.name = name
+        self.path = path
+        self.parent = parent
+        self.items = []
+        self.apps = []
+
+    def add(self, item):
+        item.parent = self
+        if isinstance(item, App):
+            item.index = len(self.apps)
+            self.apps.append(item)
+        self.items.append(item)
+
+    def first_app(self):
+        # Empty folders are never added, so this always finds an App
+        item = self.items[0]
+        return item if isinstance(item, App) else item.first_app()
+
+def scan_app_name(path):
+    # Find the 'name' entry of a macro file's app dict by reading the source
+    # text, so the menu can be built without importing every file.
+    with open(path, 'r') as f:
+        for line in f:
+            for key in ("'name'", '"name"'):
+                start = line.find(key)
+                if start < 0:
+                    continue
+                rest = line[start + len(key):].lstrip()
+                if not rest.startswith(':'):
+                    continue
+                rest = rest[1:].lstrip()
+                if rest and rest[0] in '\'"':
+                    end = rest.find(rest[0], 1)
+                    if end > 0:
+                        return rest[1:end]
+    return None
+
+def file_stem(filename):
+    return filename[:filename.rfind('.')]
+
+def file_mtime(path):
+    return os.stat(path)[8]
+
+def pick_macro_file(folder, stem, files):
+    # Only one of the macro files sharing a stem becomes an app. Import
+    # finds a .py before a .mpy, so a .mpy is only used without its
+    # source. A .json is read rather than imported, so between it and the
+    # importable file the newer one is used.
+    module = None
+    for ext in ('.py', '.mpy'):
+        if stem + ext in files:
+            module = stem + ext
+            break
+    data = stem + '.json'
+    if data in files:
+        if module is None:
+            return data
+        if file_mtime(folder + '/' + data) >= file_mtime(folder + '/' + module):
+            print("Ignoring", module, "(older than", data + ")")
+            return data
+        print("Ignoring", data, "(older than", module + ")")
+    if module == stem + '.py' and stem + '.mpy' in files:
+        if file_mtime(folder + '/' + stem + '.mpy') >= file_mtime(folder + '/' + module):
+            print("Remove", module, "so", stem + '.mpy', "is used")
+        else:
+            print("Ignoring", stem + '.mpy', "(older than", module + ")")
+    return module
 
-def read_macro_files(folder=MACRO_FOLDER):
-    apps = []
+def read_macro_files(folder=MACRO_FOLDER, name=''):
+    # Builds the Folder tree of apps; macro sequences are imported lazily.
+    # Files whose size and mtime match their macro cache entry reuse the
+    # cached name and sequences, and matched entries are removed from
+    # macro_cache so whatever is left afterwards belongs to changed or
+    # deleted files.
+    node = Folder(name, folder)
     files = os.listdir(folder)
     files.sort()
+    chosen = {}  # File stem -> the one file used for it
     for filename in files:
-        if filename.endswith('.py') and not filename.startswith('._'):
-            try:
-                module = __import__(folder + '/' + filename[:-3])
-                apps.append(App(module.app, filename, folder=folder))
-            except (SyntaxError, ImportError, AttributeError, KeyError, NameError,
-                    IndexError, TypeError) as err:
-                print("ERROR in", filename)
-                import traceback
-                traceback.print_exception(err, err, err.__traceback__)
-        elif os.stat(folder + '/' + filename)[0] & 0x4000:
-            subfolder = folder + '/' + filename
-            subapps = read_macro_files(subfolder)
-            if subapps:
-                apps.append((filename, subapps))
-    return apps
-
-def show_menu(items, current_item, inverse=False):
-    menu_group = displayio.Group()
-    total_items = len(items)
-    half_display = MENU_ITEMS // 2
-    start_index = max(0, min(current_item - half_display, total_items - MENU_ITEMS))
-    end_index = min(start_index + MENU_ITEMS, total_items)
-
-    for i in range(start_index, end_index):
-        is_selected = (i == current_item)
-        item = items[i]
-        text = item[0] if isinstance(item, tuple) else item.name
-        if isinstance(item, tuple):
-            text = f"[{text}]"
-        y_position = ((i - start_index) * 12) + 6
-        
-        if is_selected:
-            selected_bg = Rect(0, (i - start_index) * 12, macropad.display.width, 12, fill=0x000000 if inverse else 0xFFFFFF)
-            menu_group.append(selected_bg)
-        
-        menu_label = label.Label(
-            terminalio.FONT,
-            text=text,
-            color=0xFFFFFF if (inverse and is_selected) else (0x000000 if is_selected else 0xFFFFFF),
-            anchored_position=(macropad.display.width - 1, y_position),
-            anchor_point=(1.0, 0.5)
-        )
-        menu_group.append(menu_label)
-
-    macropad.display.root_group = menu_group
-    macropad.display.refresh()
-
-def flash_selected(items, current_item):
+        path = folder + '/' + filename
+        if (filename[filename.rfind('.'):] in MACRO_EXTENSIONS
+                and not filename.startswith('._')):
+            stem = file_stem(filename)
+            if stem not in chosen:
+                chosen[stem] = pick_macro_file(folder, stem, files)
+            if chosen[stem] != filename:
+                continue
+            file_stat = os.stat(path)
+            stat = (file_stat[6], file_stat[8])
+            entry = macro_cache.get(path)
+            if entry is not None and entry[0] == stat:
+                del macro_cache[path]
+                node.add(App(entry[1], filename, folder=folder, stat=stat,
+                             cache_offset=entry[2]))
+                continue
+            # A .mpy holds bytecode, so its name is only known once it has
+            # loaded (and been cached); until then the menu shows its stem
+            name = None
+            if not filename.endswith('.mpy'):
+                try:
+                    name = scan_app_name(path)
+                except (OSError, UnicodeError) as err:
+                    print("ERROR in", filename, err)
+                    continue
+            if name is None:
+                name = file_stem(filename)
+            node.add(App(name, filename, folder=folder, stat=stat))
+        elif os.stat(path)[0] & 0x4000:
+            subfolder = read_macro_files(path, filename)
+            if subfolder.items:
+                node.add(subfolder)
+    return node
+
+def all_apps(folder):
+    for item in folder.items:
+        if isinstance(item, Folder):
+            yield from all_apps(item)
+        else:
+            yield item
+
+def index_apps(folder):
+    # Rebuild the (folder, file stem) -> App lookup over the whole tree.
+    # Loading and unloading keep the same App objects, so this only needs
+    # to run again when the set of macro files changes.
+    app_index.clear()
+    for app in all_apps(folder):
+        app_index[(app.folder, file_stem(app.filename))] = app
+
+def replace_file(temp_path, path):
+    # Move a fully written temp file over path. FAT can't rename onto an
+    # existing file, so the old one is removed first.
+    try:
+        os.rename(temp_path, path)
+    except OSError:
+        os.remove(path)
+        os.rename(temp_path, path)
+
+def load_macro_cache():
+    # Returns {path: ((size, mtime), name, offset)} for each complete line of
+    # MACRO_CACHE_FILE, plus whether any line was unreadable. After the
+    # MACRO_CACHE_HEADER line, each line is path, size, mtime, name and the
+    # JSON-encoded macros, tab-separated.
+    entries = {}
+    damaged = False
+    try:
+        with open(MACRO_CACHE_FILE, 'rb') as f:
+            if f.readline() != MACRO_CACHE_HEADER:
+                # Written by a different version; rebuild from scratch
+                return entries, True
+            while True:
+                offset = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                fields = line.decode().split('\t', 4)
+                if len(fields) == 5 and line.endswith(b'\n'):
+                    # A file's entry is rewritten by appending, so a later
+                    # line for the same path replaces an earlier one and
+                    # compaction drops the earlier one
+                    if fields[0] in entries:
+                        damaged = True
+                    entries[fields[0]] = ((int(fields[1]), int(fields[2])), fields[3], offset)
+                else:
+                    damaged = True
+    except OSError:
+        pass
+    except (ValueError, UnicodeError):
+        damaged = True
+    return entries, damaged
+
+def compact_macro_cache(apps):
+    # Rewrite the cache with only the entries of current, unchanged files
+    temp_path = MACRO_CACHE_FILE + '.tmp'
+    try:
+        with open(MACRO_CACHE_FILE, 'rb') as src, open(temp_path, 'wb') as dst:
+            dst.write(MACRO_CACHE_HEADER)
+            for app in all_apps(apps):
+                if app.cache_offset is not None:
+                    src.seek(app.cache_offset)
+                    line = src.readline()
+                    app.cache_offset = dst.tell()
+                    dst.write(line)
+        replace_file(temp_path, MACRO_CACHE_FILE)
+    except OSError:
+        # Read-only filesystem or no cache yet: start over without one
+        for app in all_apps(apps):
+            app.cache_offset = None
+
+def encode_sequences(sequences):
+    # Typed text constants are bytes, stored in hex like the code
+    return [(binascii.hexlify(code).decode(),
+             [binascii.hexlify(value).decode() if isinstance(value, bytes) else value
+              for value in consts])
+            for code, consts in sequences]
+
+def decode_sequence(code, consts):
+    # JSON turns mouse motion tuples into lists; they're turned back so
+    # decoded sequences are hashable and equal to freshly compiled ones.
+    # The OP_TYPE instructions tell which strings are typed text in hex.
+    code = binascii.unhexlify(code)
+    consts = [tuple(value) if isinstance(value, list) else value for value in consts]
+    for pc in range(0, len(code), 3):
+        if code[pc] == OP_TYPE:
+            index = code[pc + 1] | (code[pc + 2] << 8)
+            if isinstance(consts[index], str):
+                consts[index] = binascii.unhexlify(consts[index])
+    return (code, tuple(consts))
+
+def decode_sequences(sequences):
+    return tuple(decode_sequence(code, consts) if code else EMPTY_SEQUENCE
+                 for code, consts in sequences)
+
+def encode_macros(app):
+    # Cached as [macros, encoder sequences or null, idle effect or null]
+    if app.name == 'Favorites':
+        return json.dumps([app.macros, None, app.idle])
+    return json.dumps([[(color, key_label, kind, encode_sequences(action))
+                        for color, key_label, kind, action in app.macros],
+                       app.encoder and encode_sequences(app.encoder), app.idle])
+
+def decode_macros(name, data):
+    macros, encoder, idle = json.loads(data)
+    if encoder:
+        encoder = decode_sequences(encoder)
+    if name == 'Favorites':
+        return [tuple(entry) for entry in macros], encoder, idle
+    return [(color, key_label, kind, decode_sequences(action))
+            for color, key_label, kind, action in macros], encoder, idle
+
+def read_cached_macros(app):
+    with open(MACRO_CACHE_FILE, 'rb') as f:
+        f.seek(app.cache_offset)
+        fields = f.readline().decode().split('\t', 4)
+    if fields[0] != app.folder + '/' + app.filename:
+        raise ValueError('stale cache offset')
+    return decode_macros(app.name, fields[4])
+
+def write_cached_macros(app):
+    if app.stat is None:
+        return
+    try:
+        line = '%s/%s\t%d\t%d\t%s\t%s\n' % (app.folder, app.filename, app.stat[0], app.stat[1],
+                                            app.name, encode_macros(app))
+    except MemoryError:
+        return  # The app itself fits; it just won't be cached
+    try:
+        # A line cut short by a reset would swallow the start of this one
+        ended = True
+        try:
+            with open(MACRO_CACHE_FILE, 'rb') as f:
+                f.seek(0, 2)
+                size = f.tell()
+                if size:
+                    f.seek(size - 1)
+                    ended = f.read(1) == b'\n'
+        except OSError:
+            pass  # No cache yet
+        with open(MACRO_CACHE_FILE, 'ab') as f:
+            f.seek(0, 2)
+            if f.tell() == 0:
+                f.write(MACRO_CACHE_HEADER)
+            elif not ended:
+                f.write(b'\n')
+            offset = f.tell()
+            f.write(line.encode())
+        app.cache_offset = offset
+    except OSError:
+        pass  # Filesystem is read-only to code.py; just skip caching
+
+class MenuView:
+    # Retained menu display: a fixed pool of MENU_ITEMS labels and one
+    # highlight bar, created once. show() only touches the labels and bar
+    # whose text, color or position differ from what is already on screen,
+    # and asks for a display refresh only if something changed.
+    def __init__(self):
+        self.group = displayio.Group()
+        self.highlight = Rect(0, 0, macropad.display.width, 12, fill=0xFFFFFF)
+        self.highlight_fill = 0xFFFFFF
+        self.group.append(self.highlight)
+        self.labels = []
+        self.texts = [''] * MENU_ITEMS
+        self.colors = [0xFFFFFF] * MENU_ITEMS
+        for row in range(MENU_ITEMS):
+            menu_label = label.Label(terminalio.FONT, text='', color=0xFFFFFF,
+                                     anchored_position=(macropad.display.width - 1, row * 12 + 6),
+                                     anchor_point=(1.0, 0.5))
+            self.labels.append(menu_label)
+            self.group.append(menu_label)
+
+    def show(self, items, current_item, inverse=False, up=None):
+        total_items = len(items)
+        half_display = MENU_ITEMS // 2
+        start_index = max(0, min(current_item - half_display, total_items - MENU_ITEMS))
+        changed = False
+
+        for row in range(MENU_ITEMS):
+            i = start_index + row
+            if i < total_items:
+                item = items[i]
+                if item is up:
+                    text = '[..]'
+                elif isinstance(item, Folder):
+                    text = f"[{item.name}]"
+                else:
+                    text = item.name
+            else:
+                text = ''
+            is_selected = (i == current_item)
+            color = 0xFFFFFF if (inverse or not is_selected) else 0x000000
+            if text != self.texts[row]:
+                self.labels[row].text = text
+                self.texts[row] = text
+                changed = True
+            if color != self.colors[row]:
+                self.labels[row].color = color
+                self.colors[row] = color
+                changed = True
+
+        highlight_y = (current_item - start_index) * 12
+        if highlight_y != self.highlight.y:
+            self.highlight.y = highlight_y
+            changed = True
+        fill = 0x000000 if inverse else 0xFFFFFF
+        if fill != self.highlight_fill:
+            self.highlight.fill = fill
+            self.highlight_fill = fill
+            changed = True
+
+        if macropad.display.root_group is not self.group:
+            macropad.display.root_group = self.group
+            changed = True
+        if changed:
+            request_refresh()
+
+class LoopScheduler:
+    # Paces the main loop. While there is input the loop only yields to the
+    # macro tasks; after IDLE_BACKOFF_AFTER seconds without input it sleeps,
+    # doubling the sleep each pass up to IDLE_MAX_SLEEP. Any input drops it
+    # straight back to full speed. Key presses are queued by the keypad
+    # scanner in the background, so backing off never loses events.
+    #
+    # Times are supervisor.ticks_ms() values, which stay small ints (unlike
+    # time.monotonic_ns()), so pacing each pass doesn't allocate.
+    #
+    # Telemetry: loops_per_second (over the last full second),
+    # worst_iteration_ms (longest pass, excluding the sleep, since
+    # reset_stats()) and idle_ms (total time spent sleeping).
+    def __init__(self):
+        now = supervisor.ticks_ms()
+        self.last_input = now
+        self.sleep = 0
+        self.iteration_start = now
+        self.window_start = now
+        self.window_loops = 0
+        self.loops_per_second = 0
+        self.worst_iteration_ms = 0
+        self.idle_ms = 0
+
+    def input(self):
+        self.last_input = supervisor.ticks_ms()
+        self.sleep = 0
+        if leds.idle:
+            leds.wake.set()  # Bring the LEDs back from the idle effect
+
+    def since_input(self):
+        # Milliseconds since the last input
+        return ticks_diff(supervisor.ticks_ms(), self.last_input)
+
+    def reset_stats(self):
+        self.worst_iteration_ms = 0
+        self.idle_ms = 0
+
+    async def pause(self):
+        now = supervisor.ticks_ms()
+        iteration = ticks_diff(now, self.iteration_start)
+        if iteration > self.worst_iteration_ms:
+            self.worst_iteration_ms = iteration
+        self.window_loops += 1
+        window = ticks_diff(now, self.window_start)
+        if window >= 1000:
+            self.loops_per_second = self.window_loops * 1000 // window
+            self.window_start = now
+            self.window_loops = 0
+        if ticks_diff(now, self.last_input) >= IDLE_BACKOFF_AFTER * 1000:
+            self.sleep = min(IDLE_MAX_SLEEP, self.sleep * 2 if self.sleep else IDLE_MIN_SLEEP)
+        await asyncio.sleep(self.sleep)
+        self.iteration_start = supervisor.ticks_ms()
+        self.idle_ms += ticks_diff(self.iteration_start, now)
+
+# Stages timed by Probes; PROBE_STAGES holds their names for the summary
+PROBE_DISPLAY = 0    # display.refresh() in refresh_display()
+PROBE_PIXELS = 1     # pixels.show()
+PROBE_WRITE = 2      # keyboard_layout.write()
+PROBE_GC = 3         # gc.collect() after dropping an app
+PROBE_FAVORITES = 4  # favorites JSON load and save
+PROBE_LOAD = 5       # importing and compiling a macro file
+PROBE_KEY = 6        # handling one key event in the main loop
+PROBE_STAGES = ('display', 'pixels', 'write', 'gc', 'favorites', 'load', 'key')
+
+class Probes:
+    # Timing probes for the slow operations on the main path. Each sample
+    # is a stage number and a duration in milliseconds, written into
+    # preallocated arrays used as a ring buffer. Durations come from
+    # supervisor.ticks_ms(), a small int, so recording doesn't allocate.
+    # summary() prints per-stage min, mean, p99 and max; it is triggered
+    # by typing 'p' on the serial console (or 'r' to reset), or by
+    # clicking the encoder while holding a key.
+    def __init__(self, size):
+        self.stages = bytearray(size)
+        self.millis = array.array('L', [0] * size)
+        self.next = 0
+        self.count = 0
+
+    def start(self):
+        return supervisor.ticks_ms()
+
+    def stop(self, stage, start):
+        i = self.next
+        self.stages[i] = stage
+        self.millis[i] = ticks_diff(supervisor.ticks_ms(), start)
+        self.next = (i + 1) % len(self.stages)
+        if self.count < len(self.stages):
+            self.count += 1
+
+    def reset(self):
+        self.next = 0
+        self.count = 0
+
+    def summary(self):
+        print("stage         n    min   mean    p99    max (ms)")
+        for stage, name in enumerate(PROBE_STAGES):
+            samples = sorted(self.millis[i] for i in range(self.count) if self.stages[i] == stage)
+            if samples:
+                print("%-9s %5d %6d %6d %6d %6d" % (
+                    name, len(samples), samples[0], sum(samples) // len(samples),
+                    samples[min(len(samples) - 1, len(samples) * 99 // 100)], samples[-1]))
+        print("loop: %d/s, worst pass %d ms" % (
+            scheduler.loops_per_second, scheduler.worst_iteration_ms))
+        print("shared: %d bytes across %d loaded apps" % (interner.saved, len(loaded_apps)))
+
+def request_refresh():
+    # Everything that changes the screen calls this instead of refreshing;
+    # refresh_display() pushes the changes when the main loop yields
+    display_dirty.set()
+
+async def refresh_display():
+    # Runs as its own task, so a display push never sits between a key
+    # press and its macro. Changes that arrive while one frame is on its
+    # way are pushed together in the next, at most DISPLAY_MAX_FPS a second.
+    while True:
+        await display_dirty.wait()
+        display_dirty.clear()
+        start = probes.start()
+        macropad.display.refresh()
+        probes.stop(PROBE_DISPLAY, start)
+        await asyncio.sleep(1 / DISPLAY_MAX_FPS)
+
+def show_pixels():
+    start = probes.start()
+    macropad.pixels.show()
+    probes.stop(PROBE_PIXELS, start)
+
+LED_IDLE_EFFECTS = ('none', 'breathe', 'off')
+
+def blend(color, target, weight):
+    # color moved toward target by weight/255, per channel
+    r = color >> 16
+    g = color >> 8 & 0xFF
+    b = color & 0xFF
+    r += ((target >> 16) - r) * weight // 255
+    g += ((target >> 8 & 0xFF) - g) * weight // 255
+    b += ((target & 0xFF) - b) * weight // 255
+    return r << 16 | g << 8 | b
+
+class LedAnimator:
+    # Drives the key LEDs from its own task. Each frame builds every key's
+    # color from its app color (cross-faded from the previous app's after
+    # a switch), a white highlight for presses that fades after release
+    # and ripples to the neighbouring keys, and the app's idle effect,
+    # using gamma and brightness tables computed once. Only keys whose
+    # color changed are written to the pixel buffer, and one pixels.show()
+    # pushes the frame. Once LED_FRAME_BUDGET is used up the remaining keys
+    # wait for the next frame. With nothing animating the task sleeps
+    # until a press, release or switch wakes it.
+    NEIGHBOURS = tuple(tuple(n for n in (i - 3, i + 3, i - 1 if i % 3 else -1,
+                                         i + 1 if i % 3 < 2 else -1) if 0 <= n < 12)
+                       for i in range(12))
+
+    def __init__(self):
+        self.gamma = bytes(int(255 * (i / 255) ** LED_GAMMA + 0.5) for i in range(256))
+        self.scale = bytes(int(i * LED_BRIGHTNESS + 0.5) for i in range(256))
+        self.base = [None] * 12  # App colors
+        self.previous = [0] * 12  # Colors being faded away from after a switch
+        self.fade = bytearray(12)  # Cross-fade left, 255 just after a switch
+        self.level = bytearray(12)  # White highlight, 255 while pressed
+        self.held = [False] * 12
+        self.frame = [None] * 12  # Colors currently in the pixel buffer
+        self.idle_effect = LED_IDLE_EFFECT
+        self.idle = False  # The idle effect is showing
+        self.wake = asyncio.Event()
+
+    def fade_to(self, key, color):
+        self.previous[key] = self.frame[key] or 0
+        self.base[key] = color
+        self.fade[key] = 255
+        self.wake.set()
+
+    def press(self, key):
+        self.held[key] = True
+        self.level[key] = 255
+        for neighbour in LedAnimator.NEIGHBOURS[key]:
+            self.level[neighbour] = max(self.level[neighbour], LED_RIPPLE)
+        self.wake.set()
+
+    def release(self, key):
+        self.held[key] = False
+        self.wake.set()
+
+    def idle_factor(self, now):
+        # Brightness (0-255) the idle effect allows right now
+        self.idle = (self.idle_effect != 'none' and
+                     scheduler.since_input() >= LED_IDLE_AFTER * 1000)
+        if not self.idle:
+            return 255
+        if self.idle_effect == 'off':
+            return 0
+        phase = now % LED_BREATHE_PERIOD / LED_BREATHE_PERIOD
+        return self.gamma[int(255 * (1 - abs(2 * phase - 1)))]
+
+    def render(self, now, elapsed):
+        # Returns whether anything is still animating
+        deadline = ticks_add(supervisor.ticks_ms(), int(LED_FRAME_BUDGET * 1000))
+        step = max(1, min(255, int(255 * elapsed / LED_FADE)))
+        idle = self.idle_factor(now)
+        animating = self.idle and self.idle_effect == 'breathe'
+        changed = False
+        for i in range(12):
+            color = self.base[i] or 0
+            if self.fade[i]:
+                color = blend(color, self.previous[i], self.gamma[self.fade[i]])
+                self.fade[i] = max(0, self.fade[i] - step)
+                animating = True
+            if self.level[i]:
+                color = blend(color, 0xFFFFFF, self.gamma[self.level[i]])
+                if not self.held[i]:
+                    self.level[i] = max(0, self.level[i] - step)
+                    animating = True
+            elif idle < 255:
+                color = blend(color, 0, 255 - idle)
+            if LED_BRIGHTNESS != 1:
+                color = (self.scale[color >> 16] << 16 | self.scale[color >> 8 & 0xFF] << 8 |
+                         self.scale[color & 0xFF])
+            if color != self.frame[i]:
+                macropad.pixels[i] = color
+                self.frame[i] = color
+                changed = True
+            if ticks_diff(supervisor.ticks_ms(), deadline) > 0:
+                animating = True
+                break
+        if changed:
+            show_pixels()
+        return animating
+
+    async def run(self):
+        last = time.monotonic()
+        while True:
+            now = time.monotonic()
+            animating = self.render(now, now - last)
+            last = now
+            if animating:
+                await asyncio.sleep(1 / LED_FPS)
+                continue
+            # Nothing moving: sleep until woken, or until the idle effect is due
+            self.wake.clear()
+            idle_at = now + LED_IDLE_AFTER - scheduler.since_input() / 1000
+            if self.idle_effect != 'none' and not self.idle and idle_at > now:
+                try:
+                    await asyncio.wait_for(self.wake.wait(), idle_at - now)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await self.wake.wait()
+            last = time.monotonic()
+
+def read_console():
+    # Single-letter commands typed on the serial console
+    while supervisor.runtime.serial_bytes_available:
+        command = sys.stdin.read(1)
+        if command == 'p':
+            probes.summary()
+        elif command == 'r':
+            probes.reset()
+            scheduler.reset_stats()
+        elif command == 'm':
+            print_memory()
+
+def print_memory():
+    # Heap footprint of every app measured so far; * marks loaded apps
+    gc.collect()
+    print("free heap: %d bytes%s" % (gc.mem_free(), " (low memory)" if low_memory() else ""))
+    for app in sorted(app_index.values(), key=lambda app: -(app.footprint or 0)):
+        if app.footprint is not None:
+            print("%7d %s %s/%s" % (app.footprint, '*' if app in loaded_apps else ' ',
+                                    app.folder, app.filename))
+
+async def flash_selected(items, current_item, up=None):
     for _ in range(2):
-        show_menu(items, current_item, inverse=True)
-        time.sleep(0.05)
-        show_menu(items, current_item, inverse=False)
-        time.sleep(0.05)
-
-def navigate_menu(items):
-    current_item = 0
-    show_menu(items, current_item)
+        menu_view.show(items, current_item, inverse=True, up=up)
+        await asyncio.sleep(0.05)
+        menu_view.show(items, current_item, inverse=False, up=up)
+        await asyncio.sleep(0.05)
+
+async def navigate_menu(folder):
+    # Lists folder's items, led by the folder above it (shown as [..])
+    # below the top level. The highlight starts on the folder's own first
+    # item. Returns the chosen App or Folder, or None if the menu times out.
+    up = folder.parent
+    items = folder.items if up is None else [up] + folder.items
+    current_item = 1 if up is not None and folder.items else 0
+    menu_view.show(items, current_item, up=up)
     menu_timeout = time.monotonic() + 3
     last_encoder_position = macropad.encoder
 
@@ -119,110 +839,877 @@ def navigate_menu(items):
         current_encoder_position = macropad.encoder
         
         if current_encoder_position != last_encoder_position:
+            scheduler.input()
             current_item = (current_item + current_encoder_position - last_encoder_position) % len(items)
-            show_menu(items, current_item)
+            menu_view.show(items, current_item, up=up)
             menu_timeout = time.monotonic() + 3
             last_encoder_position = current_encoder_position
 
         if macropad.encoder_switch_debounced.pressed:
-            flash_selected(items, current_item)
+            await flash_selected(items, current_item, up)
             return items[current_item]
 
         if time.monotonic() > menu_timeout:
             return None
 
-        time.sleep(0.01)
+        await scheduler.pause()
 
 def load_favorites():
+    # A leftover temp file means a reset landed between removing the old file
+    # and renaming the new one into place. It was fully written, so use it.
+    start = probes.start()
+    loaded = {}
+    for path in (FAVORITES_FILE, FAVORITES_FILE + '.tmp'):
+        try:
+            with open(path, 'r') as f:
+                loaded = json.load(f)
+            break
+        except (OSError, ValueError):
+            pass
+    probes.stop(PROBE_FAVORITES, start)
+    return loaded
+
+def save_favorites():
+    # Write to a temp file first so a reset never leaves a half-written file
+    global favorites_changed
+    favorites_changed = None
+    temp_path = FAVORITES_FILE + '.tmp'
+    start = probes.start()
     try:
-        with open(FAVORITES_FILE, 'r') as f:
-            return json.load(f)
-    except (OSError, ValueError):
-        return {}
+        with open(temp_path, 'w') as f:
+            json.dump(favorites, f)
+        replace_file(temp_path, FAVORITES_FILE)
+    except OSError as err:
+        print("Could not save favorites:", err)
+    probes.stop(PROBE_FAVORITES, start)
 
-def save_favorites(favorites):
-    with open(FAVORITES_FILE, 'w') as f:
-        json.dump(favorites, f)
+def flush_favorites():
+    # Called from the main loop; writes once changes have settled
+    if favorites_changed is not None and time.monotonic() - favorites_changed >= FAVORITES_SAVE_DELAY:
+        save_favorites()
 
 def set_favorite(key, app):
-    favorites = load_favorites()
+    global favorites_changed
     favorites[str(key)] = {'name': app.name, 'filename': app.filename, 'folder': app.folder}
-    save_favorites(favorites)
+    favorites_changed = time.monotonic()
 
 def get_favorite(key):
-    favorites = load_favorites()
-    if str(key) in favorites:
-        fav = favorites[str(key)]
-        for app in apps:
-            if isinstance(app, App) and app.filename == fav['filename'] and app.folder == fav['folder']:
-                return app
+    fav = favorites.get(str(key))
+    if fav:
+        # By stem, so a favorite survives its file being converted or compiled
+        return app_index.get((fav['folder'], file_stem(fav['filename'])))
     return None
 
-def execute_macro(sequence):
+# Macro sequences are compiled at load time into a flat stream of 3-byte
+# instructions: an opcode followed by a 16-bit little-endian operand. Strings,
+# file names and mouse motion tuples live in a per-sequence constants tuple
+# and the operand is their index. A compiled sequence is a (code, consts) pair.
+# Typed strings are resolved to keycodes at load time and become one OP_TYPE
+# whose constant holds a (modifier, keycode) byte pair per character, unless
+# the keyboard layout can't type them that way.
+# OP_CALL is only added when loaded apps are interned (see intern_macros):
+# its constant is a shared fragment of code with no constants of its own.
+OP_PRESS = 0          # keyboard.press(operand)
+OP_RELEASE = 1        # keyboard.release(operand)
+OP_DELAY = 2          # sleep for operand milliseconds
+OP_WRITE = 3          # keyboard_layout.write(consts[operand])
+OP_CC_PRESS = 4       # consumer_control release + press(operand)
+OP_CC_RELEASE = 5     # consumer_control.release()
+OP_MOUSE_PRESS = 6    # mouse.press(operand)
+OP_MOUSE_RELEASE = 7  # mouse.release(operand)
+OP_MOUSE_MOVE = 8     # mouse.move(*consts[operand])
+OP_TONE = 9           # stop_tone + start_tone(operand)
+OP_STOP_TONE = 10     # stop_tone()
+OP_PLAY = 11          # play_file(consts[operand])
+OP_TYPE = 12          # press and release each (modifier, keycode) pair in consts[operand]
+OP_CALL = 13          # run the code fragment consts[operand], then carry on
+CONST_OPS = bytes((OP_WRITE, OP_MOUSE_MOVE, OP_PLAY, OP_TYPE, OP_CALL))  # Opcodes that use consts
+
+EMPTY_SEQUENCE = (b'', ())
+MOUSE_KEYS = ('buttons', 'x', 'y', 'wheel', 'tone', 'play')
+
+# Compiled key entries are (color, label, kind, action). A plain macro's
+# action is (press sequence, release sequence): the first runs on key down
+# and the second, which lets go of whatever the first left held, on key up.
+# A tap-dance macro is written as a dict with any of TAP_DANCE_ACTIONS as
+# keys, and its action is a tuple of four sequences in that order. A repeat
+# macro is written as {'repeat': sequence} and its action is a one-sequence
+# tuple that releases whatever it pressed, replayed while the key is held.
+MACRO_PLAIN = 0
+MACRO_TAP_DANCE = 1
+MACRO_REPEAT = 2
+TAP_DANCE_ACTIONS = ('tap', 'double_tap', 'hold', 'tap_hold')
+
+def resolve_string(text):
+    # The OP_TYPE constant for typing text, or None if some character needs
+    # more than one modifier (or has no keycode) and must go through write()
+    pairs = bytearray()
+    for char in text:
+        try:
+            codes = macropad.keyboard_layout.keycodes(char)
+        except ValueError:
+            return None
+        if len(codes) == 1:
+            pairs.append(0)
+            pairs.append(codes[0])
+        elif len(codes) == 2:
+            pairs.append(codes[0])
+            pairs.append(codes[1])
+        else:
+            return None
+    return bytes(pairs)
+
+def compile_sequence(sequence):
+    code = bytearray()
+    consts = []
+
+    def emit(op, operand=0):
+        if not 0 <= operand <= 0xFFFF:
+            raise ValueError('operand out of range: ' + str(operand))
+        code.append(op)
+        code.append(operand & 0xFF)
+        code.append(operand >> 8)
+
+    def const(value):
+        if value not in consts:
+            consts.append(value)
+        return consts.index(value)
+
+    def delay(seconds):
+        ms = int(seconds * 1000 + 0.5)
+        while ms > 0xFFFF:
+            emit(OP_DELAY, 0xFFFF)
+            ms -= 0xFFFF
+        emit(OP_DELAY, ms)
+
+    if isinstance(sequence, str):
+        sequence = (sequence,)  # A bare string is typed as-is
+    elif not isinstance(sequence, (list, tuple)):
+        raise ValueError('sequence must be a list: ' + repr(sequence))
     for item in sequence:
         if isinstance(item, int):
             if item >= 0:
-                macropad.keyboard.press(item)
+                emit(OP_PRESS, item)
             else:
-                macropad.keyboard.release(-item)
+                emit(OP_RELEASE, -item)
         elif isinstance(item, float):
-            time.sleep(item)
+            delay(item)
         elif isinstance(item, str):
-            macropad.keyboard_layout.write(item)
+            typed = resolve_string(item)
+            if typed is None:
+                emit(OP_WRITE, const(item))
+            elif typed:
+                emit(OP_TYPE, const(typed))
         elif isinstance(item, list):
-            for code in item:
-                if isinstance(code, int):
-                    macropad.consumer_control.release()
-                    macropad.consumer_control.press(code)
-                if isinstance(code, float):
-                    time.sleep(code)
+            for code_item in item:
+                if isinstance(code_item, int):
+                    if code_item >= 0:
+                        emit(OP_CC_PRESS, code_item)
+                    else:
+                        emit(OP_CC_RELEASE)
+                elif isinstance(code_item, float):
+                    delay(code_item)
+                else:
+                    raise ValueError('bad consumer control item: ' + repr(code_item))
         elif isinstance(item, dict):
+            for key in item:
+                if key not in MOUSE_KEYS:
+                    raise ValueError('unknown mouse/tone key: ' + repr(key))
             if 'buttons' in item:
                 if item['buttons'] >= 0:
-                    macropad.mouse.press(item['buttons'])
+                    emit(OP_MOUSE_PRESS, item['buttons'])
                 else:
-                    macropad.mouse.release(-item['buttons'])
-            macropad.mouse.move(item['x'] if 'x' in item else 0,
-                                item['y'] if 'y' in item else 0,
-                                item['wheel'] if 'wheel' in item else 0)
+                    emit(OP_MOUSE_RELEASE, -item['buttons'])
+            motion = (item.get('x', 0), item.get('y', 0), item.get('wheel', 0))
+            for value in motion:
+                if not isinstance(value, int):
+                    raise ValueError('mouse motion must be int: ' + repr(value))
+            if motion != (0, 0, 0):
+                emit(OP_MOUSE_MOVE, const(motion))
             if 'tone' in item:
                 if item['tone'] > 0:
-                    macropad.stop_tone()
-                    macropad.start_tone(item['tone'])
+                    emit(OP_TONE, item['tone'])
                 else:
-                    macropad.stop_tone()
+                    emit(OP_STOP_TONE)
             elif 'play' in item:
-                macropad.play_file(item['play'])
+                emit(OP_PLAY, const(item['play']))
+        else:
+            raise ValueError('bad sequence item: ' + repr(item))
+    if not code:
+        return EMPTY_SEQUENCE
+    return (bytes(code), tuple(consts))
 
-def handle_tap_dance(key_number, pressed):
-    global last_press_time, tap_count, is_long_press
+def release_items(sequence):
+    # Source items that let go of everything the sequence leaves pressed:
+    # keys, consumer control code, mouse buttons and tone
+    keys = []
+    consumer = False
+    buttons = 0
+    tone = False
+    if isinstance(sequence, str):
+        return []
+    for item in sequence:
+        if isinstance(item, int):
+            if item >= 0:
+                keys.append(item)
+            elif -item in keys:
+                keys.remove(-item)
+        elif isinstance(item, list):
+            for code_item in item:
+                if isinstance(code_item, int):
+                    consumer = code_item >= 0
+        elif isinstance(item, dict):
+            if item.get('buttons', 0) > 0:
+                buttons |= item['buttons']
+            elif item.get('buttons', 0) < 0:
+                buttons &= ~-item['buttons']
+            if 'tone' in item:
+                tone = item['tone'] > 0
+    items = [-key for key in reversed(keys)]
+    if consumer:
+        items.append([-1])
+    if buttons:
+        items.append({'buttons': -buttons})
+    if tone:
+        items.append({'tone': 0})
+    return items
 
-    current_time = time.monotonic()
-    
-    if pressed:
-        if current_time - last_press_time <= TAP_DANCE_TIMEOUT:
-            tap_count += 1
-        else:
-            tap_count = 1
-        last_press_time = current_time
-        is_long_press = False
+def compile_macro(key_index, entry):
+    color, key_label, sequence = entry
+    try:
+        if isinstance(sequence, dict) and 'repeat' in sequence:
+            if len(sequence) > 1:
+                raise ValueError("'repeat' can't be mixed with tap-dance actions")
+            steps = sequence['repeat']
+            if isinstance(steps, str):
+                steps = [steps]
+            elif not isinstance(steps, list):
+                raise ValueError('repeat must be a list')
+            return (color, key_label, MACRO_REPEAT,
+                    (compile_sequence(steps + release_items(steps)),))
+        if isinstance(sequence, dict):
+            for action in sequence:
+                if action not in TAP_DANCE_ACTIONS:
+                    raise ValueError('unknown tap-dance action: ' + repr(action))
+            # Tap-dance actions fire and forget, so each one releases
+            # whatever it pressed when it finishes
+            actions = []
+            for action in TAP_DANCE_ACTIONS:
+                steps = sequence.get(action, [])
+                if isinstance(steps, str):
+                    steps = [steps]
+                elif not isinstance(steps, list):
+                    raise ValueError(action + ' must be a list')
+                actions.append(compile_sequence(steps + release_items(steps)))
+            return (color, key_label, MACRO_TAP_DANCE, tuple(actions))
+        return (color, key_label, MACRO_PLAIN,
+                (compile_sequence(sequence), compile_sequence(release_items(sequence))))
+    except ValueError as err:
+        raise ValueError('key %d (%s): %s' % (key_index, key_label, err))
+
+def compile_macros(macros):
+    return [compile_macro(key_index, entry) for key_index, entry in enumerate(macros)]
+
+def compile_encoder(encoder):
+    # An app's optional 'encoder' entry is a pair of sequences played for
+    # each counterclockwise and clockwise detent. Each releases what it
+    # pressed, like a tap-dance action.
+    if encoder is None:
+        return None
+    if not isinstance(encoder, (list, tuple)) or len(encoder) != 2:
+        raise ValueError('encoder must be a (counterclockwise, clockwise) pair')
+    compiled = []
+    for steps in encoder:
+        if isinstance(steps, str):
+            steps = [steps]
+        elif not isinstance(steps, list):
+            raise ValueError('encoder sequences must be lists')
+        compiled.append(compile_sequence(steps + release_items(steps)))
+    return tuple(compiled)
+
+# JSON macro files hold the same app dict as a Python macro file, with
+# Keycode, ConsumerControlCode and Mouse constants written as strings such
+# as "Keycode.COMMAND" (or "-Keycode.COMMAND" to release) and colors as
+# numbers or "0x200000" strings. They are read with JsonAppReader rather
+# than imported, so no bytecode is compiled and only one key's source is
+# held in RAM at a time.
+JSON_CHUNK = 256  # Characters read from a JSON macro file at a time
+
+class JsonAppReader:
+    # Iterating yields (key, value) for each entry of the file's top-level
+    # object, except that the 'macros' list yields ('macro', entry) once
+    # per element. Each value's text is cut out by matching brackets and
+    # quotes, then handed to json.loads on its own.
+    def __init__(self, f):
+        self.f = f
+        self.buf = ''
+        self.pos = 0
+
+    def peek(self):
+        # Next non-whitespace character, not consumed ('' at end of file)
+        while True:
+            while self.pos < len(self.buf):
+                if self.buf[self.pos] not in ' \t\r\n':
+                    return self.buf[self.pos]
+                self.pos += 1
+            self.buf = self.f.read(JSON_CHUNK)
+            self.pos = 0
+            if not self.buf:
+                return ''
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError('JSON: expected one of %s, found %r' % (chars, char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        # Text of the next JSON value
+        self.peek()
+        parts = []
+        start = self.pos
+        depth = 0
+        in_string = False
+        escaped = False
+        while True:
+            if self.pos >= len(self.buf):
+                parts.append(self.buf[start:])
+                self.buf = self.f.read(JSON_CHUNK)
+                self.pos = start = 0
+                if not self.buf:
+                    raise ValueError('JSON: unexpected end of file')
+            char = self.buf[self.pos]
+            # A number, true, false or null ends at the first delimiter after
+            # its own characters, some of which may be in parts after a refill
+            if (not depth and not in_string and char in ',]}: \t\r\n'
+                    and (parts or self.pos > start)):
+                break
+            self.pos += 1
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == '\\':
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+                    if not depth:
+                        break
+            elif char == '"':
+                in_string = True
+            elif char in '[{':
+                depth += 1
+            elif char in ']}':
+                depth -= 1
+                if not depth:
+                    break
+        parts.append(self.buf[start:self.pos])
+        return ''.join(parts)
+
+    def __iter__(self):
+        self.expect('{')
+        if self.peek() == '}':
+            return
+        while True:
+            key = json.loads(self.value())
+            self.expect(':')
+            if key == 'macros':
+                self.expect('[')
+                if self.peek() == ']':
+                    self.pos += 1
+                else:
+                    while True:
+                        yield 'macro', json.loads(self.value())
+                        if self.expect(',]') == ']':
+                            break
+            else:
+                yield key, json.loads(self.value())
+            if self.expect(',}') == '}':
+                return
+
+def json_symbol(text):
+    # Value of "Keycode.A", "-Keycode.A", "ConsumerControlCode.MUTE" or
+    # "Mouse.LEFT_BUTTON"; None for any other string, which is typed text
+    sign = 1
+    if text.startswith('-'):
+        sign = -1
+        text = text[1:]
+    prefix, _, name = text.partition('.')
+    if prefix == 'Keycode':
+        from adafruit_hid.keycode import Keycode as table
+    elif prefix == 'ConsumerControlCode':
+        from adafruit_hid.consumer_control_code import ConsumerControlCode as table
+    elif prefix == 'Mouse':
+        from adafruit_hid.mouse import Mouse as table
     else:
-        if current_time - last_press_time >= HOLD_TIMEOUT:
-            if is_long_press:
-                # Tap and Hold (Action 4)
-                execute_macro(current_app.macros[key_number][2][3])
+        return None
+    value = getattr(table, name, None)
+    if not isinstance(value, int):
+        raise ValueError('unknown name: ' + text)
+    return sign * value
+
+def json_step(item):
+    if isinstance(item, str):
+        value = json_symbol(item)
+        return item if value is None else value
+    if isinstance(item, list):
+        return [json_step(code) for code in item]
+    if isinstance(item, dict):
+        return {key: json_step(value) if key == 'buttons' else value
+                for key, value in item.items()}
+    return item
+
+def json_sequence(sequence):
+    if isinstance(sequence, dict):
+        # Tap-dance or repeat actions, each an ordinary sequence
+        return {action: json_sequence(steps) for action, steps in sequence.items()}
+    return json_step(sequence)
+
+def read_json_app(app):
+    # Keys are compiled as they stream in once the app's name is known.
+    # Object keys can come in any order, so keys read before "name" wait
+    # for it: Favorites keeps its entries as raw commands.
+    name = None
+    macros = []
+    compiled = 0  # macros[:compiled] are compiled, the rest wait for the name
+    app.encoder = app.idle = None
+    with open(app.folder + '/' + app.filename, 'r') as f:
+        for key, value in JsonAppReader(f):
+            if key == 'macro':
+                color, key_label, sequence = value
+                if isinstance(color, str):
+                    color = int(color, 16)
+                macros.append((color, key_label, json_sequence(sequence)))
+            elif key == 'name':
+                name = value
+            elif key == 'encoder':
+                app.encoder = compile_encoder(json_sequence(value))
+            elif key == 'idle':
+                app.idle = value
+            if name is not None and name != 'Favorites':
+                while compiled < len(macros):
+                    macros[compiled] = compile_macro(compiled, macros[compiled])
+                    compiled += 1
+    if name is None:
+        raise KeyError('name')
+    app.name = name
+    app.macros = macros
+
+class Interner:
+    # Shares one copy of equal values (labels, compiled sequences, typed
+    # text and code fragments) between the loaded apps. Each value counts
+    # the apps using it, so unloading an app drops whatever only that app
+    # used. saved is the number of bytes currently not duplicated thanks
+    # to sharing.
+    def __init__(self):
+        self.table = {}  # value -> [shared value, number of users]
+        self.saved = 0
+
+    def share(self, value, size):
+        entry = self.table.get(value)
+        if entry is None:
+            self.table[value] = [value, 1]
+            return value
+        entry[1] += 1
+        self.saved += size
+        return entry[0]
+
+    def drop(self, value, size):
+        # Returns whether that was the value's last user
+        entry = self.table.get(value)
+        if entry is None:
+            return False
+        entry[1] -= 1
+        if entry[1]:
+            self.saved -= size
+            return False
+        del self.table[value]
+        return True
+
+def sequence_size(sequence):
+    code, consts = sequence
+    return len(code) + sum(len(value) for value in consts if isinstance(value, (str, bytes)))
+
+def shared_consts(sequence):
+    # (index, bytes saved per extra user) for each constant shared between
+    # sequences: typed text, and code fragments, which cost their OP_CALL
+    code, consts = sequence
+    found = {}
+    for pc in range(0, len(code), 3):
+        op = code[pc]
+        if op == OP_TYPE or op == OP_CALL:
+            index = code[pc + 1] | (code[pc + 2] << 8)
+            found[index] = len(consts[index]) - (3 if op == OP_CALL else 0)
+    return found.items()
+
+def code_chunks(code):
+    # Splits compiled code around the instructions that use constants, typed
+    # text among them, so the same steps between texts come out as equal
+    # chunks wherever they appear. Constant indexes differ from sequence to
+    # sequence, so only the chunks in between can become fragments.
+    chunks = []
+    start = 0
+    for pc in range(0, len(code), 3):
+        if code[pc] in CONST_OPS:
+            if pc > start:
+                chunks.append(code[start:pc])
+            chunks.append(code[pc:pc + 3])
+            start = pc + 3
+    if start < len(code):
+        chunks.append(code[start:])
+    return chunks
+
+def call_fragments(sequence, fragments):
+    # The sequence with each chunk found in fragments replaced by an OP_CALL.
+    # Every call gets its own constant slot, so each counts as a user of
+    # the shared fragment.
+    code, consts = sequence
+    chunks = code_chunks(code)
+    if len(chunks) < 2:
+        return sequence  # Shared whole, if at all
+    calls = bytearray()
+    consts = list(consts)
+    for chunk in chunks:
+        if chunk in fragments:
+            calls.append(OP_CALL)
+            calls.append(len(consts) & 0xFF)
+            calls.append(len(consts) >> 8)
+            consts.append(chunk)
+        else:
+            calls.extend(chunk)
+    if len(consts) == len(sequence[1]):
+        return sequence
+    return (bytes(calls), tuple(consts))
+
+def intern_sequence(sequence, fragments):
+    sequence = call_fragments(sequence, fragments)
+    if sequence in interner.table:
+        return interner.share(sequence, sequence_size(sequence))
+    # A new sequence: share its typed text and fragments with the other
+    # sequences using them
+    consts = list(sequence[1])
+    for index, saving in shared_consts(sequence):
+        consts[index] = interner.share(consts[index], saving)
+    sequence = (sequence[0], tuple(consts))
+    return interner.share(sequence, sequence_size(sequence))
+
+def intern_macros(name, macros):
+    if name == 'Favorites':
+        return macros
+    # Chunks worth calling: repeated within this app, or already shared
+    # by another loaded app
+    counts = {}
+    for entry in macros:
+        for code, consts in entry[3]:
+            chunks = code_chunks(code)
+            if len(chunks) > 1:
+                for chunk in chunks:
+                    if len(chunk) >= FRAGMENT_MIN_BYTES:
+                        counts[chunk] = counts.get(chunk, 0) + 1
+    fragments = set(chunk for chunk, count in counts.items()
+                    if count > 1 or chunk in interner.table)
+    return [(color, interner.share(key_label, len(key_label)), kind,
+             tuple(intern_sequence(sequence, fragments) for sequence in action))
+            for color, key_label, kind, action in macros]
+
+def release_macros(name, macros):
+    if name == 'Favorites':
+        return
+    for color, key_label, kind, action in macros:
+        interner.drop(key_label, len(key_label))
+        for sequence in action:
+            if interner.drop(sequence, sequence_size(sequence)):
+                for index, saving in shared_consts(sequence):
+                    interner.drop(sequence[1][index], saving)
+
+class HIDOutput:
+    # Output layer between macros and the HID devices. Keyboard presses and
+    # releases are collected and sent as one press report and one release
+    # report, so a chord lands on the host all at once. Whatever has to
+    # reach the host in order - a release of a key pressed in the same
+    # batch, a press after a release, or any other device's report - sends
+    # the batch first. Consumer control and mouse button changes that
+    # wouldn't change what the host sees are dropped.
+    def __init__(self):
+        self.presses = []
+        self.releases = []
+        self.consumer = 0  # Consumer control code held, or 0
+        self.buttons = 0  # Mouse buttons held
+
+    def press(self, keycode):
+        if self.releases:
+            self.flush()
+        if keycode not in self.presses:
+            self.presses.append(keycode)
+
+    def release(self, keycode):
+        if keycode in self.presses:
+            self.flush()
+        if keycode not in self.releases:
+            self.releases.append(keycode)
+
+    def flush(self):
+        if self.presses:
+            macropad.keyboard.press(*self.presses)
+            self.presses.clear()
+        if self.releases:
+            macropad.keyboard.release(*self.releases)
+            self.releases.clear()
+
+    def consumer_press(self, code):
+        # A new code replaces the held one in a single report; only pressing
+        # the held code again needs a release in between
+        if self.consumer == code:
+            macropad.consumer_control.release()
+        macropad.consumer_control.press(code)
+        self.consumer = code
+
+    def consumer_release(self):
+        if self.consumer:
+            macropad.consumer_control.release()
+            self.consumer = 0
+
+    def mouse_press(self, buttons):
+        if buttons & ~self.buttons:
+            macropad.mouse.press(buttons)
+            self.buttons |= buttons
+
+    def mouse_release(self, buttons):
+        if buttons & self.buttons:
+            macropad.mouse.release(buttons)
+            self.buttons &= ~buttons
+
+    def release_all(self):
+        self.presses.clear()
+        self.releases.clear()
+        self.consumer = 0
+        self.buttons = 0
+        macropad.keyboard.release_all()
+        macropad.consumer_control.release()
+        macropad.mouse.release_all()
+
+async def execute_macro(sequence, speed=0):
+    # With a speed (for repeat macros), delays are divided by it and mouse
+    # motion is multiplied by it and merged into the next motion report
+    code, consts = sequence
+    keyboard = macropad.keyboard
+    caller = None  # Code to return to after an OP_CALL fragment, and where
+    return_pc = 0
+    pc = 0
+    while True:
+        if pc >= len(code):
+            if caller is None:
+                break
+            # Fragments hold no calls, so one return slot is enough
+            code, pc = caller, return_pc
+            caller = None
+            continue
+        op = code[pc]
+        operand = code[pc + 1] | (code[pc + 2] << 8)
+        pc += 3
+        if op == OP_PRESS:
+            output.press(operand)
+            continue
+        if op == OP_RELEASE:
+            output.release(operand)
+            continue
+        if op == OP_CALL:
+            caller, return_pc = code, pc
+            code, pc = consts[operand], 0
+            continue
+        # Anything else goes out after the keyboard changes before it
+        output.flush()
+        if op == OP_DELAY:
+            await asyncio.sleep(operand / 1000 / (speed or 1))
+        elif op == OP_WRITE:
+            start = probes.start()
+            macropad.keyboard_layout.write(consts[operand])
+            probes.stop(PROBE_WRITE, start)
+        elif op == OP_CC_PRESS:
+            output.consumer_press(operand)
+        elif op == OP_CC_RELEASE:
+            output.consumer_release()
+        elif op == OP_MOUSE_PRESS:
+            output.mouse_press(operand)
+        elif op == OP_MOUSE_RELEASE:
+            output.mouse_release(operand)
+        elif op == OP_MOUSE_MOVE:
+            if speed:
+                for axis in range(3):
+                    pending_motion[axis] += int(consts[operand][axis] * speed)
+            else:
+                macropad.mouse.move(*consts[operand])
+        elif op == OP_TONE:
+            macropad.stop_tone()
+            macropad.start_tone(operand)
+        elif op == OP_STOP_TONE:
+            macropad.stop_tone()
+        elif op == OP_PLAY:
+            macropad.play_file(consts[operand])
+        elif op == OP_TYPE:
+            # Only each character's keys are let go, so keys held by the
+            # macro (or another key's macro) stay down while typing
+            pairs = consts[operand]
+            for index in range(0, len(pairs), 2):
+                modifier = pairs[index]
+                if modifier:
+                    keyboard.press(modifier, pairs[index + 1])
+                    keyboard.release(modifier, pairs[index + 1])
+                else:
+                    keyboard.press(pairs[index + 1])
+                    keyboard.release(pairs[index + 1])
+                await asyncio.sleep(TYPING_DELAY)
+    output.flush()
+
+async def run_macro(key_number, sequence, release=None):
+    global hid_in_use
+    hid_in_use = True
+    try:
+        await execute_macro(sequence)
+        if release is not None:
+            await key_released[key_number].wait()
+            await execute_macro(release)
+    finally:
+        macro_tasks[key_number] = None
+
+def start_macro(key_number, sequence, release=None):
+    # Each key plays its macro as its own task so delays don't stall the main
+    # loop and macros on different keys can overlap. A key whose previous
+    # macro is still playing ignores new presses until it finishes. With a
+    # release sequence, the task plays it once the key has come back up.
+    if macro_tasks[key_number] is None and (sequence[0] or release and release[0]):
+        key_released[key_number].clear()
+        macro_tasks[key_number] = asyncio.create_task(run_macro(key_number, sequence, release))
+
+async def run_repeat(key_number, sequence):
+    # Plays the sequence once, then again every REPEAT_INTERVAL (plus any
+    # delays in it) from REPEAT_DELAY until the key is released, speeding
+    # up along the REPEAT_CURVE over REPEAT_RAMP seconds
+    global hid_in_use
+    hid_in_use = True
+    released = key_released[key_number]
+    start = time.monotonic()
+    try:
+        await execute_macro(sequence, 1)
+        while not released.is_set() and time.monotonic() - start < REPEAT_DELAY:
+            await asyncio.sleep(REPEAT_INTERVAL)
+        while not released.is_set():
+            ramp = min(1, (time.monotonic() - start - REPEAT_DELAY) / REPEAT_RAMP)
+            await execute_macro(sequence, 1 + (REPEAT_MAX_SPEED - 1) * ramp ** REPEAT_CURVE)
+            await asyncio.sleep(REPEAT_INTERVAL)
+    finally:
+        macro_tasks[key_number] = None
+
+def start_repeat(key_number, sequence):
+    if macro_tasks[key_number] is None and sequence[0]:
+        key_released[key_number].clear()
+        macro_tasks[key_number] = asyncio.create_task(run_repeat(key_number, sequence))
+
+def flush_motion():
+    # Sends the mouse motion queued by repeat macros as a single report, at
+    # most once every REPEAT_INTERVAL, however many keys contributed to it
+    global motion_due
+    now = time.monotonic()
+    if now >= motion_due:
+        x, y, wheel = pending_motion
+        pending_motion[0] = pending_motion[1] = pending_motion[2] = 0
+        macropad.mouse.move(x, y, wheel)
+        motion_due = now + REPEAT_INTERVAL
+
+def turn_encoder(change):
+    # Queues change detents for the current app's encoder binding. Fast
+    # spins count for more, scaled by how quickly the detents arrived.
+    global encoder_turned, encoder_pending, encoder_task
+    now = time.monotonic()
+    rate = abs(change) / max(now - encoder_turned, 0.001)
+    encoder_turned = now
+    scale = min(ENCODER_MAX_SCALE, max(1, rate / ENCODER_FAST_RATE))
+    encoder_pending += round(change * scale)
+    if encoder_task is None:
+        encoder_task = asyncio.create_task(run_encoder())
+
+async def run_encoder():
+    # Plays queued detents. A binding that only moves the mouse (e.g. the
+    # scroll wheel) plays once for all of them, so its motion goes out as
+    # one merged report; anything else plays once per detent.
+    global encoder_pending, encoder_task, hid_in_use
+    hid_in_use = True
+    try:
+        while encoder_pending:
+            sequence = current_app.encoder[encoder_pending > 0]
+            code = sequence[0]
+            if len(code) == 3 and code[0] == OP_MOUSE_MOVE:
+                steps = abs(encoder_pending)
+                encoder_pending = 0
+                await execute_macro(sequence, steps)
             else:
-                # Hold (Action 3)
-                execute_macro(current_app.macros[key_number][2][2])
-        elif tap_count == 1:
-            # Single Tap (Action 1)
-            execute_macro(current_app.macros[key_number][2][0])
-        elif tap_count == 2:
+                encoder_pending += -1 if encoder_pending > 0 else 1
+                await execute_macro(sequence)
+            await asyncio.sleep(0)
+    finally:
+        encoder_task = None
+
+def cancel_macros():
+    global encoder_pending, encoder_task
+    for task in macro_tasks:
+        if task is not None:
+            task.cancel()
+    if encoder_task is not None:
+        encoder_task.cancel()
+        encoder_task = None
+    encoder_pending = 0
+    for i in range(len(macro_tasks)):
+        macro_tasks[i] = None
+    pending_motion[0] = pending_motion[1] = pending_motion[2] = 0
+
+class TapDance:
+    # Tap-dance state machine for one key, so keys pressed together keep
+    # their own timing. update() runs every main loop pass: a single tap
+    # fires as soon as the double-tap window closes, and a hold fires once
+    # the key has been down for HOLD_TIMEOUT, without waiting for release.
+    IDLE = 0
+    DOWN = 1  # Pressed; becomes a hold unless released in time
+    UP = 2  # Released after one tap; waiting for a second tap
+    HELD = 3  # Hold action has fired; waiting for release
+
+    def __init__(self, key_number):
+        self.key_number = key_number
+        self.reset()
+
+    def reset(self):
+        self.state = TapDance.IDLE
+        self.taps = 0
+        self.since = 0  # time.monotonic() of the last press or release
+
+    def press(self, now):
+        self.taps = 2 if self.state == TapDance.UP else 1
+        self.state = TapDance.DOWN
+        self.since = now
+
+    def release(self, now):
+        if self.state == TapDance.DOWN and self.taps == 1:
+            self.state = TapDance.UP
+            self.since = now
+            return
+        if self.state == TapDance.DOWN:
             # Double Tap (Action 2)
-            execute_macro(current_app.macros[key_number][2][1])
-        
-        tap_count = 0
-        is_long_press = False
+            self.fire(1)
+        self.state = TapDance.IDLE
+
+    def update(self, now):
+        if self.state == TapDance.DOWN:
+            if now - self.since >= HOLD_TIMEOUT:
+                # Hold (Action 3) or Tap and Hold (Action 4)
+                self.fire(2 if self.taps == 1 else 3)
+                self.state = TapDance.HELD
+        elif self.state == TapDance.UP:
+            if now - self.since >= TAP_DANCE_TIMEOUT:
+                # Single Tap (Action 1)
+                self.fire(0)
+                self.state = TapDance.IDLE
+
+    def fire(self, action):
+        start_macro(self.key_number, current_app.macros[self.key_number][3][action])
 
 # INITIALIZATION -----------------------
 
@@ -244,93 +1731,160 @@ group.append(label.Label(terminalio.FONT, text='', color=0x000000,
                          anchored_position=(macropad.display.width//2, -1),
                          anchor_point=(0.5, 0.0)))
 macropad.display.root_group = group
+menu_view = MenuView()
+scheduler = LoopScheduler()
+display_dirty = asyncio.Event()  # Set when the screen has changes to push
+leds = LedAnimator()
+probes = Probes(PROBE_SAMPLES)
 
-apps = read_macro_files()
+macro_tasks = [None] * 12  # Running macro task per key, or None
+hid_in_use = True  # A macro has run since HID devices were last released
+tap_dances = [TapDance(key_index) for key_index in range(12)]
+key_released = [asyncio.Event() for key_index in range(12)]
+output = HIDOutput()  # Batches macro HID changes into as few reports as possible
+pending_motion = [0, 0, 0]  # Mouse x, y, wheel queued by repeat macros
+motion_due = 0  # time.monotonic() when queued motion may next be sent
+encoder_task = None  # Task playing the current app's encoder binding, or None
+encoder_pending = 0  # Detents queued for it, positive clockwise
+encoder_turned = 0  # time.monotonic() of the last encoder movement
+loaded_apps = []  # Apps with macros in RAM, least recently used first
+interner = Interner()  # Labels and sequences shared between loaded apps
 
-if not apps:
+macro_cache, macro_cache_damaged = load_macro_cache()
+apps = read_macro_files()  # Root Folder of the macro tree
+if macro_cache or macro_cache_damaged:
+    # Entries left over are for changed or deleted files
+    compact_macro_cache(apps)
+macro_cache = None
+app_index = {}  # (folder, file stem) -> App, for every app at any depth
+index_apps(apps)
+
+favorites = load_favorites()  # Kept in RAM; changes are written behind by flush_favorites()
+favorites_changed = None  # time.monotonic() of the last unsaved change, or None
+
+if not apps.items:
     group[13].text = 'NO MACRO FILES FOUND'
-    macropad.display.refresh()
+    macropad.display.refresh()  # Nothing else will ever run, so push it now
     while True:
         pass
 
-current_app = apps[0] if isinstance(apps[0], App) else apps[0][1][0]
+current_app = apps.first_app()
 current_app.switch()
 
 # MAIN LOOP ----------------------------
 
-last_encoder_position = macropad.encoder
-setting_favorite = False
-last_press_time = 0
-tap_count = 0
-is_long_press = False
-
-while True:
-    macropad.encoder_switch_debounced.update()
-    if macropad.encoder_switch_debounced.pressed:
-        selected_item = navigate_menu(apps)
-        if selected_item:
-            if isinstance(selected_item, App):
+async def main():
+    global current_app
+
+    last_encoder_position = macropad.encoder
+    setting_favorite = False
+    keys_held = 0
+    asyncio.create_task(refresh_display())
+    asyncio.create_task(leds.run())
+
+    while True:
+        # Yields to the macro tasks every pass, and sleeps when idle
+        await scheduler.pause()
+
+        if supervisor.runtime.serial_bytes_available:
+            read_console()
+
+        macropad.encoder_switch_debounced.update()
+        if macropad.encoder_switch_debounced.pressed and keys_held:
+            # Click while holding a key: print the probe summary instead
+            probes.summary()
+        elif macropad.encoder_switch_debounced.pressed:
+            scheduler.input()
+            # Choosing a folder opens it (or, for [..], goes back up), so
+            # apps at any depth can be reached
+            selected_item = await navigate_menu(apps)
+            while isinstance(selected_item, Folder):
+                selected_item = await navigate_menu(selected_item)
+            if selected_item:
                 current_app = selected_item
                 current_app.switch()
-            elif isinstance(selected_item, tuple):
-                current_app = selected_item[1][0]
+            macropad.display.root_group = group
+            request_refresh()
+            last_encoder_position = macropad.encoder
+
+        current_encoder_position = macropad.encoder
+        if current_encoder_position != last_encoder_position:
+            scheduler.input()
+            encoder_change = current_encoder_position - last_encoder_position
+            if current_app.encoder:
+                # The app's own encoder binding comes first...
+                turn_encoder(encoder_change)
+            elif current_app.parent is not apps:
+                # ...otherwise inside a subfolder (at any depth) the encoder
+                # steps through the apps that share current_app's folder
+                siblings = current_app.parent.apps
+                current_app = siblings[(current_app.index + encoder_change) % len(siblings)]
                 current_app.switch()
-        macropad.display.root_group = group
-        macropad.display.refresh()
-        last_encoder_position = macropad.encoder
-    
-    current_encoder_position = macropad.encoder
-    if current_app.folder != MACRO_FOLDER and current_encoder_position != last_encoder_position:
-        current_folder_name = current_app.folder.split('/')[-1]
-        current_folder = [app for app in apps if isinstance(app, tuple) and app[0] == current_folder_name][0][1]
-        current_index = current_folder.index(current_app)
-        encoder_change = current_encoder_position - last_encoder_position
-        new_index = (current_index + encoder_change) % len(current_folder)
-        current_app = current_folder[new_index]
-        current_app.switch()
-        last_encoder_position = current_encoder_position
-
-    event = macropad.keys.events.get()
-    if event:
-        key_number = event.key_number
-        pressed = event.pressed
-
-        if key_number < len(current_app.macros):
-            if current_app.name == 'Favorites':
-                if pressed:
-                    sequence = current_app.macros[key_number][2]
-                    if sequence[0] == 'SET_FAVORITE':
-                        setting_favorite = True
-                        group[13].text = 'Set Favorite'
-                        macropad.display.refresh()
-                    elif sequence[0] == 'BACK_TO_MAIN':
-                        current_app = apps[0] if isinstance(apps[0], App) else apps[0][1][0]
-                        current_app.switch()
-                    elif sequence[0].startswith('FAVORITE_'):
-                        fav_num = int(sequence[0].split('_')[1])
-                        fav_app = get_favorite(fav_num - 1)
-                        if fav_app:
-                            current_app = fav_app
+            last_encoder_position = current_encoder_position
+
+        event = macropad.keys.events.get()
+        if event:
+            scheduler.input()
+            start = probes.start()
+            key_number = event.key_number
+            pressed = event.pressed
+            keys_held = max(0, keys_held + (1 if pressed else -1))
+
+            if key_number < len(current_app.macros):
+                if current_app.name == 'Favorites':
+                    if pressed:
+                        sequence = current_app.macros[key_number][2]
+                        if sequence[0] == 'SET_FAVORITE':
+                            setting_favorite = True
+                            group[13].text = 'Set Favorite'
+                            request_refresh()
+                        elif sequence[0] == 'BACK_TO_MAIN':
+                            current_app = apps.first_app()
                             current_app.switch()
-            elif setting_favorite:
-                if pressed:
-                    set_favorite(key_number, current_app)
-                    setting_favorite = False
-                    group[13].text = 'Favorite Set'
-                    macropad.display.refresh()
-                    time.sleep(1)
-                    current_app.switch()
-            else:
-                handle_tap_dance(key_number, pressed)
-
-            if pressed and key_number < 12:
-                macropad.pixels[key_number] = 0xFFFFFF
-                macropad.pixels.show()
-            elif not pressed and key_number < 12:
-                macropad.pixels[key_number] = current_app.macros[key_number][0]
-                macropad.pixels.show()
-
-    # Check for long press
-    if time.monotonic() - last_press_time >= HOLD_TIMEOUT and not is_long_press:
-        is_long_press = True
-        # This will trigger the Hold action when the key is released
\ No newline at end of file
+                        elif sequence[0].startswith('FAVORITE_'):
+                            fav_num = int(sequence[0].split('_')[1])
+                            fav_app = get_favorite(fav_num - 1)
+                            if fav_app:
+                                current_app = fav_app
+                                current_app.switch()
+                elif setting_favorite:
+                    if pressed:
+                        set_favorite(key_number, current_app)
+                        setting_favorite = False
+                        group[13].text = 'Favorite Set'
+                        request_refresh()
+                        await asyncio.sleep(1)
+                        current_app.switch()
+                else:
+                    color, key_label, kind, action = current_app.macros[key_number]
+                    if kind == MACRO_TAP_DANCE:
+                        if pressed:
+                            tap_dances[key_number].press(time.monotonic())
+                        else:
+                            tap_dances[key_number].release(time.monotonic())
+                    elif kind == MACRO_REPEAT and pressed:
+                        start_repeat(key_number, action[0])
+                    elif pressed:
+                        # Plain macros fire on the press edge...
+                        start_macro(key_number, action[0], action[1])
+                    else:
+                        # ...and let go of held keys on the release edge
+                        key_released[key_number].set()
+
+                if key_number < 12:
+                    if pressed:
+                        leds.press(key_number)
+                    else:
+                        leds.release(key_number)
+            probes.stop(PROBE_KEY, start)
+
+        now = time.monotonic()
+        for tap_dance in tap_dances:
+            if tap_dance.state:
+                tap_dance.update(now)
+
+        if pending_motion[0] or pending_motion[1] or pending_motion[2]:
+            flush_motion()
+        flush_favorites()
+
+asyncio.run(main())
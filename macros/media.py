@@ -12,6 +12,8 @@
 # the list, which is why you'll see double brackets [[ ]] below.
 # Like Keycodes, Consumer Control codes can be positive (press) or negative
 # (release), and float values can be inserted for pauses.
+# Volume and brightness use {'repeat': [...]} to keep stepping while held;
+# the 0.1 second pause sets their starting pace.
 
 # To reference Consumer Control codes, import ConsumerControlCode like so...
 from adafruit_hid.consumer_control_code import ConsumerControlCode
@@ -24,12 +26,12 @@ app = {               # REQUIRED dict, must be named 'app'
         # COLOR    LABEL    KEY SEQUENCE
         # 1st row ----------
         (0x000000, '', []),
-        (0x000020, 'Vol+', [[ConsumerControlCode.VOLUME_INCREMENT]]),
-        (0x202020, 'Bright+', [[ConsumerControlCode.BRIGHTNESS_INCREMENT]]),
+        (0x000020, 'Vol+', {'repeat': [[ConsumerControlCode.VOLUME_INCREMENT], 0.1]}),
+        (0x202020, 'Bright+', {'repeat': [[ConsumerControlCode.BRIGHTNESS_INCREMENT], 0.1]}),
         # 2nd row ----------
         (0x000000, '', []),
-        (0x000020, 'Vol-', [[ConsumerControlCode.VOLUME_DECREMENT]]),
-        (0x202020, 'Bright-', [[ConsumerControlCode.BRIGHTNESS_DECREMENT]]),
+        (0x000020, 'Vol-', {'repeat': [[ConsumerControlCode.VOLUME_DECREMENT], 0.1]}),
+        (0x202020, 'Bright-', {'repeat': [[ConsumerControlCode.BRIGHTNESS_DECREMENT], 0.1]}),
         # 3rd row ----------
         (0x000000, '', []),
         (0x200000, 'Mute', [[ConsumerControlCode.MUTE]]),
@@ -40,5 +42,8 @@ app = {               # REQUIRED dict, must be named 'app'
         (0x202000, '>>', [[ConsumerControlCode.SCAN_NEXT_TRACK]]),
         # Encoder button ---
         (0x000000, '', [])
-    ]
+    ],
+    # Turning the encoder changes the volume (counterclockwise, clockwise)
+    'encoder' : ([[ConsumerControlCode.VOLUME_DECREMENT]],
+                 [[ConsumerControlCode.VOLUME_INCREMENT]])
 }
@@ -13,6 +13,8 @@
 # dict can have any mix of keys 'buttons' w/integer mask of button values
 # (positive to press, negative to release), 'x' w/horizontal motion,
 # 'y' w/vertical and 'wheel' with scrollwheel motion.
+# Wrapping a sequence in {'repeat': [...]} replays it while the key is held,
+# speeding up the longer it's held, as used for the arrows below.
 
 # To reference Mouse constants, import Mouse like so...
 from adafruit_hid.mouse import Mouse
@@ -29,17 +31,19 @@ app = {               # REQUIRED dict, must be named 'app'
         (0x002000, 'R', [{'buttons':Mouse.RIGHT_BUTTON}]),
         # 2nd row ----------
         (0x000000, '', []),
-        (0x202020, 'Up', [{'y':-10}]),
+        (0x202020, 'Up', {'repeat': [{'y':-10}]}),
         (0x000000, '', []),
         # 3rd row ----------
-        (0x202020, 'Left', [{'x':-10}]),
+        (0x202020, 'Left', {'repeat': [{'x':-10}]}),
         (0x000000, '', []),
-        (0x202020, 'Right', [{'x':10}]),
+        (0x202020, 'Right', {'repeat': [{'x':10}]}),
         # 4th row ----------
         (0x000000, '', []),
-        (0x202020, 'Down', [{'y':10}]),
+        (0x202020, 'Down', {'repeat': [{'y':10}]}),
         (0x000000, '', []),
         # Encoder button ---
         (0x000000, '', [])
-    ]
+    ],
+    # Turning the encoder scrolls (counterclockwise up, clockwise down)
+    'encoder' : ([{'wheel':1}], [{'wheel':-1}])
 }
@@ -0,0 +1,349 @@
+"""
+Benchmarks for the MacroPad hotkeys program, run on the host.
+
+Uses tools/simulator.py to run the unmodified code.py against fake
+hardware and times the paths that matter on the device:
+
+    boot      cold and warm (cached) boot to the first main loop pass,
+              and read_macro_files on its own
+    load      per-app import + compile, load from the macro cache,
+              compiled size and retained RAM
+    sequence  interpreting each app's longest macro with delays skipped
+    dispatch  key press to first HID report, while active and after idling
+    menu      MenuView.show frame time while scrolling the whole menu
+    switch    App.switch between sibling apps and across the whole tree
+    json      the same apps loaded from .py and from converted .json files,
+              total time and the largest peak allocation of any one load
+
+Results are a flat JSON object of metric name -> number, printed or
+written with --json, so runs can be kept and compared. With --compare
+OLD.json, metrics that got worse by more than --threshold percent are
+listed and the exit status is 1.
+
+Host timings are only meaningful relative to other host runs, and RAM
+figures are CPython allocations, which are several times larger than
+MicroPython's for the same objects.
+
+Usage:
+
+    python tools/benchmark.py [--only boot,load,...] [--repeat N]
+                              [--json FILE] [--compare OLD.json]
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from simulator import Simulator, iter_apps, parse_script  # pylint: disable=wrong-import-position
+import macros_to_json  # pylint: disable=wrong-import-position
+
+SECTIONS = ('boot', 'load', 'sequence', 'dispatch', 'menu', 'switch', 'json')
+
+# HELPERS ------------------------------
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+def ms(seconds):
+    return round(seconds * 1000, 4)
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def app_key(app):
+    # Metric-name-safe identifier for an app, e.g. 'minecraft/minecraft-pe-equip'
+    folder = app.folder.split('/macros', 1)[-1].strip('/')
+    name = app.filename.rsplit('.', 1)[0]
+    return folder + '/' + name if folder else name
+
+def sequence_bytes(sequence):
+    # Opcode stream plus the typed text and code fragments it refers to
+    code, consts = sequence
+    return len(code) + sum(len(value) for value in consts if isinstance(value, bytes))
+
+def compiled_size(app):
+    # Bytes of every compiled sequence of an app
+    total = 0
+    for entry in app.macros or ():
+        if len(entry) < 4:
+            continue  # Favorites keeps raw command strings
+        for sequence in entry[3]:
+            total += sequence_bytes(sequence)
+    return total
+
+def refresh_requested(ns):
+    # Whether the code under test asked for a display refresh, which the
+    # refresh task would push once the main loop yields; clears the request
+    requested = ns['display_dirty'].is_set()
+    ns['display_dirty'].clear()
+    return requested
+
+def booted(**kwargs):
+    return Simulator(settle=0, **kwargs).run()
+
+def load_everything(ns):
+    # Import every app once so each one has a macro cache entry
+    for app in iter_apps(ns):
+        app.load()
+
+# BENCHMARKS ---------------------------
+
+def bench_boot(results, repeat):
+    root = tempfile.mkdtemp(prefix='circuitpy-')
+    cold, warm, scan_cold, scan_warm = [], [], [], []
+    try:
+        for _ in range(repeat):
+            cache = os.path.join(root, 'macros.cache')
+            if os.path.exists(cache):
+                os.remove(cache)
+            sim = booted(root=root)
+            cold.append(sim.boot_time)
+            ns = sim.namespace
+            ns['macro_cache'] = {}
+            scan_cold.append(timed(ns['read_macro_files']))
+            load_everything(ns)
+
+            sim = booted(root=root)
+            warm.append(sim.boot_time)
+            ns = sim.namespace
+            ns['macro_cache'] = ns['load_macro_cache']()[0]
+            scan_warm.append(timed(ns['read_macro_files']))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    results['boot.cold_ms'] = ms(median(cold))
+    results['boot.warm_ms'] = ms(median(warm))
+    results['boot.read_macro_files.cold_ms'] = ms(median(scan_cold))
+    results['boot.read_macro_files.warm_ms'] = ms(median(scan_warm))
+
+def bench_load(results, repeat):
+    sim = booted(trace_memory=True)
+    ns = sim.namespace
+    ns['MAX_LOADED_APPS'] = 1000  # No eviction while measuring
+    gc = ns['gc']
+    try:
+        for app in iter_apps(ns):
+            key = 'load.' + app_key(app)
+            cold, warm, ram = [], [], []
+            for _ in range(repeat):
+                app.unload()
+                app.cache_offset = None
+                gc.collect()
+                before = tracemalloc.get_traced_memory()[0]
+                cold.append(timed(app.load))
+                gc.collect()
+                ram.append(tracemalloc.get_traced_memory()[0] - before)
+                app.unload()
+                gc.collect()
+                warm.append(timed(app.load))
+            results[key + '.cold_ms'] = ms(median(cold))
+            if app.cache_offset is not None:
+                results[key + '.cached_ms'] = ms(median(warm))
+            results[key + '.ram_bytes'] = median(ram)
+            results[key + '.compiled_bytes'] = compiled_size(app)
+            app.unload()
+        # Bytes shared between apps when every app is resident (reported as
+        # a negative so that, like every other metric, lower is better)
+        load_everything(ns)
+        results['load.all.shared_bytes'] = -ns['interner'].saved
+    finally:
+        tracemalloc.stop()
+        sim.cleanup()
+
+def bench_sequence(results, repeat):
+    # Interpreter plus HID cost of each app's longest sequence. Delays are
+    # skipped so the figure isn't just the sum of the macro's sleeps.
+    sim = booted()
+    ns = sim.namespace
+    ns['MAX_LOADED_APPS'] = 1000
+
+    async def no_sleep(_):
+        pass
+
+    real_asyncio = ns['asyncio']
+    ns['asyncio'] = types.SimpleNamespace(sleep=no_sleep)
+    try:
+        for app in iter_apps(ns):
+            app.load()
+            longest = None
+            for entry in app.macros:
+                if len(entry) < 4:
+                    continue
+                for sequence in entry[3]:
+                    if longest is None or sequence_bytes(sequence) > sequence_bytes(longest):
+                        longest = sequence
+            if not longest or not longest[0]:
+                continue
+            runs = [timed(asyncio.run, ns['execute_macro'](longest)) for _ in range(repeat)]
+            results['sequence.' + app_key(app) + '_ms'] = ms(median(runs))
+    finally:
+        ns['asyncio'] = real_asyncio
+        sim.cleanup()
+
+def bench_dispatch(results, repeat):
+    apps = ('/macros/1numpad.py', '/macros/arc/nav.py', '/macros/media.py', '/macros/mouse.py')
+    for mode, gap in (('active', 0.1), ('idle', 1.5)):
+        lines = []
+        t = 0.1
+        for path in apps:
+            lines.append('%.3f app %s' % (t, path))
+            t += 0.1
+            for key in range(repeat):
+                lines.append('%.3f tap %d' % (t, (key * 4) % 12))
+                t += gap
+        sim = Simulator(parse_script('\n'.join(lines)), settle=0.2).run()
+        latencies = sim.dispatch_latencies()
+        sim.cleanup()
+        if latencies:
+            results['dispatch.%s.mean_ms' % mode] = ms(sum(latencies) / len(latencies))
+            results['dispatch.%s.max_ms' % mode] = ms(max(latencies))
+
+def bench_menu(results, repeat):
+    sim = booted()
+    ns = sim.namespace
+    items = ns['apps'].items
+    show = ns['menu_view'].show
+    frames = []
+    refreshes = 0
+    for _ in range(repeat):
+        for i in list(range(len(items))) + list(range(len(items) - 1, -1, -1)):
+            frames.append(timed(show, items, i))
+            refreshes += refresh_requested(ns)
+    results['menu.frame.mean_ms'] = ms(sum(frames) / len(frames))
+    results['menu.frame.max_ms'] = ms(max(frames))
+    results['menu.refreshes_per_frame'] = round(refreshes / len(frames), 3)
+    sim.cleanup()
+
+def bench_switch(results, repeat):
+    sim = booted()
+    ns = sim.namespace
+    arc = [app for app in iter_apps(ns) if app.folder.endswith('/arc')]
+    for app in arc:
+        app.load()  # Within MAX_LOADED_APPS, so these stay resident
+    times = []
+    refreshes = 0
+    refresh_requested(ns)
+    for _ in range(repeat * 10):
+        for app in arc:
+            times.append(timed(app.switch))
+            refreshes += refresh_requested(ns)
+    results['switch.siblings.mean_ms'] = ms(sum(times) / len(times))
+    results['switch.siblings.refreshes_per_switch'] = round(refreshes / len(times), 3)
+
+    # Across the whole tree, so most switches also load (and evict) an app
+    times = []
+    for _ in range(repeat):
+        for app in iter_apps(ns):
+            times.append(timed(app.switch))
+    results['switch.all.mean_ms'] = ms(sum(times) / len(times))
+    results['switch.all.max_ms'] = ms(max(times))
+    sim.cleanup()
+
+def bench_json(results, repeat):
+    # Uncached loads only; once cached, both formats load the same way
+    source = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'macros')
+    macro_dir = tempfile.mkdtemp(prefix='macros-json-')
+    try:
+        for folder, _, files in os.walk(source):
+            target = os.path.join(macro_dir, os.path.relpath(folder, source))
+            os.makedirs(target, exist_ok=True)
+            for filename in files:
+                if filename.endswith('.py'):
+                    app = macros_to_json.load_app(os.path.join(folder, filename))
+                    with open(os.path.join(target, filename[:-3] + '.json'), 'w') as f:
+                        f.write(macros_to_json.to_json(app))
+        for fmt, folder in (('py', None), ('json', macro_dir)):
+            sim = booted(macro_dir=folder, trace_memory=True)
+            ns = sim.namespace
+            ns['MAX_LOADED_APPS'] = 1000
+            gc = ns['gc']
+            times, peak = [], 0
+            try:
+                for _ in range(repeat):
+                    total = 0
+                    for app in iter_apps(ns):
+                        app.unload()
+                        app.cache_offset = None
+                        gc.collect()
+                        tracemalloc.reset_peak()
+                        before = tracemalloc.get_traced_memory()[0]
+                        total += timed(app.load)
+                        peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+                    times.append(total)
+            finally:
+                tracemalloc.stop()
+                sim.cleanup()
+            results['json.%s.load_all_ms' % fmt] = ms(median(times))
+            results['json.%s.peak_bytes' % fmt] = peak
+    finally:
+        shutil.rmtree(macro_dir, ignore_errors=True)
+
+# COMPARISON ---------------------------
+
+def compare(results, old, threshold):
+    # Every metric is lower-is-better; report the ones that grew too much
+    worse = []
+    for name, value in sorted(results.items()):
+        before = old.get(name)
+        if not before or not isinstance(value, (int, float)):
+            continue
+        change = (value - before) * 100 / abs(before)
+        if change > threshold:
+            worse.append((name, before, value, change))
+    for name, before, value, change in worse:
+        print('WORSE %-50s %12s -> %12s (%+.1f%%)' % (name, before, value, change))
+    return not worse
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--only', help='comma-separated sections (default: all of %s)'
+                        % ','.join(SECTIONS))
+    parser.add_argument('--repeat', type=int, default=3, help='repetitions per measurement')
+    parser.add_argument('--json', help='write results to FILE instead of stdout')
+    parser.add_argument('--compare', help='earlier results to check for regressions')
+    parser.add_argument('--threshold', type=float, default=25.0,
+                        help='percent increase counted as a regression (default 25)')
+    args = parser.parse_args()
+
+    sections = args.only.split(',') if args.only else SECTIONS
+    results = {}
+    for section in sections:
+        if section not in SECTIONS:
+            parser.error('unknown section: ' + section)
+        print('running', section, file=sys.stderr)
+        # code.py's console output would get mixed into the JSON
+        with contextlib.redirect_stdout(sys.stderr):
+            globals()['bench_' + section](results, args.repeat)
+
+    output = {'meta': {'python': platform.python_version(), 'machine': platform.machine(),
+                       'repeat': args.repeat, 'time': int(time.time())},
+              'results': results}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(output, f, indent=1, sort_keys=True)
+    else:
+        print(json.dumps(output, indent=1, sort_keys=True))
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)['results']
+        if not compare(results, old, args.threshold):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Precompiles the macros/ tree to .mpy bytecode for the MacroPad.
+
+Every .py macro file is compiled with mpy-cross into a copy of the tree
+that can be put on the CIRCUITPY drive as /macros. Other files (.json
+macro files, sounds) are copied unchanged. The device then loads apps
+without compiling their source, which is where most of an uncached
+app's load time and peak RAM go.
+
+The sources are left out of the output on purpose: when foo.py and
+foo.mpy are both present, import finds foo.py first, so code.py uses
+the .py and prints a note when the .mpy is newer.
+
+mpy-cross must come from the same CircuitPython version as the board,
+since the .mpy format changes between releases; download it from
+https://adafruit-circuit-python.s3.amazonaws.com/index.html?prefix=bin/mpy-cross/
+and pass its path with --mpy-cross if it isn't on PATH.
+
+For each file the report lists source and .mpy sizes and the share of a
+host import spent compiling, which is roughly the share of an uncached
+device load that the .mpy saves. Host timings are only a guide to the
+proportion, not to the device's absolute times.
+
+Usage:
+
+    python tools/build_macros.py [--source macros] [--out build/macros]
+                                 [--mpy-cross PATH]
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import macros_to_json  # pylint: disable=wrong-import-position
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# HELPERS ------------------------------
+
+def median_time(func, *args, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return sorted(times)[repeat // 2]
+
+def compile_share(path):
+    # Fraction of importing the file (compile + run) spent compiling
+    with open(path) as f:
+        source = f.read()
+    compile_time = median_time(compile, source, path, 'exec')
+    import_time = median_time(macros_to_json.load_app, path)
+    return compile_time / import_time if import_time else 0.0
+
+def build(source, out, mpy_cross):
+    # Yields (relative path, source bytes, mpy bytes, compile share) per .py
+    for folder, dirs, files in os.walk(source):
+        dirs[:] = sorted(d for d in dirs if d != '__pycache__' and not d.startswith('.'))
+        target = os.path.join(out, os.path.relpath(folder, source))
+        os.makedirs(target, exist_ok=True)
+        for filename in sorted(files):
+            if filename.startswith('._'):
+                continue
+            path = os.path.join(folder, filename)
+            if not filename.endswith('.py'):
+                shutil.copy2(path, target)
+                continue
+            mpy = os.path.join(target, filename[:-3] + '.mpy')
+            subprocess.run([mpy_cross, '-o', mpy, '-s', filename, path], check=True)
+            yield (os.path.relpath(path, source), os.path.getsize(path),
+                   os.path.getsize(mpy), compile_share(path))
+
+# MAIN ---------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--source', default=os.path.join(REPO_ROOT, 'macros'),
+                        help='macro tree to compile (default: macros/)')
+    parser.add_argument('--out', default=os.path.join(REPO_ROOT, 'build', 'macros'),
+                        help='output tree, replaced if it exists (default: build/macros)')
+    parser.add_argument('--mpy-cross', default='mpy-cross', help='mpy-cross executable')
+    args = parser.parse_args()
+
+    if shutil.which(args.mpy_cross) is None:
+        parser.error('mpy-cross not found: ' + args.mpy_cross)
+    if os.path.abspath(args.out) == os.path.abspath(args.source):
+        parser.error('--out must differ from --source')
+    shutil.rmtree(args.out, ignore_errors=True)
+
+    print('%-45s %8s %8s %8s' % ('file', 'source', 'mpy', 'saved'))
+    total_source = total_mpy = 0
+    weighted_share = 0.0
+    for name, source_size, mpy_size, share in build(args.source, args.out, args.mpy_cross):
+        print('%-45s %8d %8d %7.0f%%' % (name, source_size, mpy_size, share * 100))
+        total_source += source_size
+        total_mpy += mpy_size
+        weighted_share += share * source_size
+    if total_source:
+        print('%-45s %8d %8d %7.0f%%' % ('total', total_source, total_mpy,
+                                        weighted_share * 100 / total_source))
+    print('wrote', args.out)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""
+Converts Python macro files to the JSON macro format.
+
+A JSON macro file holds the same app dict as a Python one, with Keycode,
+ConsumerControlCode and Mouse constants written as strings such as
+"Keycode.COMMAND" or "-Keycode.COMMAND", and colors as "0xRRGGBB"
+strings. code.py streams these files instead of importing them, so
+loading an app needs no bytecode compilation and much less peak RAM.
+
+Each macro file is run on the host with stand-in adafruit_hid modules
+that return the constants' names instead of their values, so the output
+keeps the symbolic names. Files that do more than build the app dict
+(loops, arithmetic on keycodes) still convert as long as the constants
+only end up as sequence items.
+
+With --check, code.py's streaming reader (JsonAppReader) is run over
+a set of awkward sample documents and over each converted or given
+.json file at every chunk size up to CHECK_CHUNKS, and must produce what
+json.load does. This needs the simulator's requirements.
+
+Usage:
+
+    python tools/macros_to_json.py macros/media.py [...] [--out DIR] [--check]
+    python tools/macros_to_json.py --check [macros/media.json ...]
+
+Without --out, each FILE.py is written alongside as FILE.json. code.py
+uses whichever of the two is newer, so the .json is used until the .py
+is edited again.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import types
+
+CHECK_CHUNKS = 64  # Largest JSON_CHUNK tried by --check
+
+# Values ending exactly at a chunk boundary, escapes, nesting and keys in
+# any order, for --check
+CHECK_SAMPLES = (
+    '{}',
+    '{"macros": []}',
+    '{"idle": null, "name": "A", "macros": [[1, "x", []]]}',
+    '{"size": 12345, "name": "D", "scale": -0.5, "macros": []}',
+    '{"name":"B","macros":[[4096,"k",["Keycode.A",0.25,-4]],[0,"",[]]],"idle":true}',
+    '{ "macros" : [ [ "0x10" , "q\\\"]}" , [ "a,b" , { "x" : -12 } ] ] ] ,\n'
+    '  "encoder" : [ [ 1.5e2 ] , [ false ] ] , "name" : "C\\u00e9" }',
+)
+
+# HELPERS ------------------------------
+
+class Symbol(str):
+    """A named HID constant, negatable like the integer it stands for."""
+
+    def __neg__(self):
+        return Symbol(self[1:] if self.startswith('-') else '-' + self)
+
+class Constants:
+    """Stand-in for Keycode, ConsumerControlCode or Mouse."""
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return Symbol(self._name + '.' + attr)
+
+def fake_hid_modules():
+    modules = {'adafruit_hid': types.ModuleType('adafruit_hid')}
+    for module, name in (('keycode', 'Keycode'),
+                         ('consumer_control_code', 'ConsumerControlCode'),
+                         ('mouse', 'Mouse')):
+        fake = types.ModuleType('adafruit_hid.' + module)
+        setattr(fake, name, Constants(name))
+        modules['adafruit_hid.' + module] = fake
+    return modules
+
+def load_app(path):
+    saved = {name: sys.modules.get(name) for name in fake_hid_modules()}
+    sys.modules.update(fake_hid_modules())
+    try:
+        namespace = {'__name__': os.path.basename(path)[:-3], '__file__': path}
+        with open(path) as f:
+            exec(compile(f.read(), path, 'exec'), namespace)  # pylint: disable=exec-used
+        return namespace['app']
+    finally:
+        for name, module in saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+def color_text(color):
+    return '"0x%06X"' % color if isinstance(color, int) else json.dumps(color)
+
+def to_json(app):
+    # One macro per line, so the file diffs and edits like the Python source
+    lines = ['{', ' "name": %s,' % json.dumps(app['name'])]
+    for key in ('encoder', 'idle'):
+        if app.get(key) is not None:
+            lines.append(' %s: %s,' % (json.dumps(key), json.dumps(app[key])))
+    macros = []
+    for color, key_label, sequence in app['macros']:
+        macros.append('  [%s, %s, %s]' % (color_text(color), json.dumps(key_label),
+                                          json.dumps(sequence)))
+    lines.append(' "macros": [')
+    lines.append(',\n'.join(macros))
+    lines.append(' ]')
+    lines.append('}')
+    return '\n'.join(lines) + '\n'
+
+def expected_items(text):
+    # What JsonAppReader should yield for a document
+    items = []
+    for key, value in json.loads(text).items():
+        if key == 'macros':
+            items.extend(('macro', entry) for entry in value)
+        else:
+            items.append((key, value))
+    return items
+
+def check_reader(documents):
+    # Returns (name, chunk size, error) for every mismatch
+    from simulator import Simulator  # pylint: disable=import-outside-toplevel
+    with contextlib.redirect_stdout(sys.stderr):  # code.py's console output
+        sim = Simulator(settle=0).run()
+    ns = sim.namespace
+    failures = []
+    try:
+        for name, text in documents:
+            expected = expected_items(text)
+            for chunk in range(1, CHECK_CHUNKS + 1):
+                ns['JSON_CHUNK'] = chunk
+                try:
+                    items = list(ns['JsonAppReader'](io.StringIO(text)))
+                except ValueError as err:
+                    failures.append((name, chunk, repr(err)))
+                    continue
+                if items != expected:
+                    failures.append((name, chunk, 'different result'))
+    finally:
+        sim.cleanup()
+    return failures
+
+# MAIN ---------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('files', nargs='*', help='Python macro files (or .json with --check)')
+    parser.add_argument('--out', help='directory for the .json files')
+    parser.add_argument('--check', action='store_true',
+                        help="check code.py's streaming reader at every chunk size")
+    args = parser.parse_args()
+    if not args.files and not args.check:
+        parser.error('no files given')
+
+    documents = [('sample %d' % i, text) for i, text in enumerate(CHECK_SAMPLES)]
+    for path in args.files:
+        if path.endswith('.json'):
+            with open(path) as f:
+                documents.append((path, f.read()))
+            continue
+        text = to_json(load_app(path))
+        documents.append((path, text))
+        json.loads(text)  # Sanity check before anything is written
+        folder = args.out or os.path.dirname(path)
+        target = os.path.join(folder, os.path.basename(path)[:-3] + '.json')
+        with open(target, 'w') as f:
+            f.write(text)
+        print('%s -> %s (%d -> %d bytes)' % (path, target, os.path.getsize(path), len(text)))
+
+    if args.check:
+        failures = check_reader(documents)
+        for name, chunk, error in failures:
+            print('FAIL %s at JSON_CHUNK=%d: %s' % (name, chunk, error))
+        print('checked %d documents at chunk sizes 1-%d' % (len(documents), CHECK_CHUNKS))
+        if failures:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,586 @@
+"""
+Host-side simulator for the MacroPad hotkeys program.
+
+Runs the unmodified code.py under CPython against fake MacroPad hardware:
+keys, encoder, encoder switch, pixels, display and HID devices. Every HID
+report is recorded with a timestamp, and key/encoder input comes from a
+scripted event stream, so dispatch behaviour and latency can be examined
+without a board attached.
+
+The real adafruit_hid package is used for report generation (install it on
+the host with `pip install adafruit-circuitpython-hid`); only the USB
+devices underneath it are fake.
+
+Script format, one event per line ('#' starts a comment):
+
+    0.10 press 3        # key 3 down at t=0.10 s
+    0.20 release 3
+    0.50 tap 4          # press + release 50 ms apart
+    1.00 turn 1         # encoder +1 detent (negative for CCW)
+    1.50 click          # encoder switch press + release
+    2.00 app Media      # jump straight to an app by name or by file path
+    2.50 app /macros/zzz_blank.py
+
+Usage:
+
+    python tools/simulator.py [--script FILE] [--all-apps] [--json FILE]
+"""
+
+import argparse
+import builtins
+import gc as host_gc
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAP_SIZE = 190 * 1024  # Roughly what CircuitPython leaves free on an RP2040
+TRACED_HEAP_SIZE = 1 << 30  # Heap reported while tracing host allocations (see FakeGC)
+
+# FAKE HARDWARE ------------------------
+
+class SimulationComplete(Exception):
+    """Raised from the fake key queue once the script has been played out."""
+
+class Clock:
+    """Monotonic clock relative to simulation start."""
+
+    def __init__(self):
+        self.start = time.monotonic()
+
+    def now(self):
+        return time.monotonic() - self.start
+
+class HIDRecorder:
+    """Collects (timestamp, device, report) tuples from every fake device."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.reports = []
+
+    def device(self, name, usage_page, usage):
+        return FakeHIDDevice(self, name, usage_page, usage)
+
+class FakeHIDDevice:
+    def __init__(self, recorder, name, usage_page, usage):
+        self.recorder = recorder
+        self.name = name
+        self.usage_page = usage_page
+        self.usage = usage
+
+    def send_report(self, report, report_id=None):
+        self.recorder.reports.append((self.recorder.clock.now(), self.name, bytes(report)))
+
+class Event:
+    def __init__(self, key_number, pressed, timestamp):
+        self.key_number = key_number
+        self.pressed = pressed
+        self.released = not pressed
+        self.timestamp = timestamp  # Scripted time, which may be before code.py polls
+
+class FakeEventQueue:
+    """Replays the key part of a script as keypad.Event objects."""
+
+    def __init__(self, sim):
+        self.sim = sim
+
+    def get(self):
+        return self.sim.next_key_event()
+
+    def clear(self):
+        pass
+
+    def __len__(self):
+        return 0
+
+class FakeKeys:
+    def __init__(self, sim):
+        self.events = FakeEventQueue(sim)
+
+class FakeDebouncer:
+    def __init__(self, sim):
+        self.sim = sim
+        self.value = False
+        self.pressed = False
+        self.released = False
+
+    def update(self):
+        value = self.sim.encoder_switch_state()
+        self.pressed = value and not self.value
+        self.released = self.value and not value
+        self.value = value
+
+class FakePixels:
+    def __init__(self, count=12):
+        self._values = [0] * count
+        self.auto_write = True
+        self.brightness = 1.0
+        self.shows = 0
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, index):
+        return self._values[index]
+
+    def __setitem__(self, index, value):
+        if isinstance(value, tuple):
+            value = (value[0] << 16) | (value[1] << 8) | value[2]
+        self._values[index] = value
+
+    def fill(self, value):
+        for i in range(len(self._values)):
+            self[i] = value
+
+    def show(self):
+        self.shows += 1
+
+class FakeDisplay:
+    width = 128
+    height = 64
+
+    def __init__(self):
+        self.auto_refresh = True
+        self.root_group = None
+        self.refreshes = 0
+
+    def refresh(self, *args, **kwargs):
+        self.refreshes += 1
+        return True
+
+class FakeMacroPad:
+    """Stand-in for adafruit_macropad.MacroPad backed by the simulator."""
+
+    def __init__(self, sim):
+        from adafruit_hid.keyboard import Keyboard
+        from adafruit_hid.keyboard_layout_us import KeyboardLayoutUS
+        from adafruit_hid.consumer_control import ConsumerControl
+        from adafruit_hid.mouse import Mouse
+
+        self._sim = sim
+        rec = sim.recorder
+        self.keyboard = Keyboard(rec.device('keyboard', 0x01, 0x06))
+        self.keyboard_layout = KeyboardLayoutUS(self.keyboard)
+        self.consumer_control = ConsumerControl(rec.device('consumer', 0x0C, 0x01))
+        self.mouse = Mouse(rec.device('mouse', 0x01, 0x02))
+        self.keys = FakeKeys(sim)
+        self.encoder_switch_debounced = FakeDebouncer(sim)
+        self.pixels = FakePixels()
+        self.display = FakeDisplay()
+        self.tones = []
+        sim.macropad = self
+
+    @property
+    def encoder(self):
+        return self._sim.encoder_position
+
+    @property
+    def encoder_switch(self):
+        return self._sim.encoder_switch_state()
+
+    def start_tone(self, frequency):
+        self.tones.append((self._sim.clock.now(), frequency))
+
+    def stop_tone(self):
+        if self.tones and self.tones[-1][1]:
+            self.tones.append((self._sim.clock.now(), 0))
+
+    def play_file(self, file_name):
+        self.tones.append((self._sim.clock.now(), file_name))
+
+# FAKE DISPLAYIO -----------------------
+
+class Group(list):
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.hidden = False
+        self.x = kwargs.get('x', 0)
+        self.y = kwargs.get('y', 0)
+
+class Label:
+    def __init__(self, font=None, text='', color=0xFFFFFF, background_color=None,
+                 anchored_position=(0, 0), anchor_point=(0, 0), **kwargs):
+        self.font = font
+        self.text = text
+        self.color = color
+        self.background_color = background_color
+        self.anchor_point = anchor_point
+        self.anchored_position = anchored_position
+        self.hidden = False
+        self.x = anchored_position[0]
+        self.y = anchored_position[1]
+
+class Rect:
+    def __init__(self, x, y, width, height, fill=None, outline=None, stroke=1):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.fill = fill
+        self.outline = outline
+        self.hidden = False
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    return module
+
+class FakeGC:
+    """gc replacement exposing mem_free()/mem_alloc().
+
+    Allocation is measured with tracemalloc when trace_memory is set; it
+    slows the host down noticeably, so it is off unless asked for. Host
+    objects are several times larger than CircuitPython's, so a traced run
+    reports a TRACED_HEAP_SIZE heap: differences between mem_free()
+    readings are real host bytes, but the heap never runs low.
+    """
+
+    def __init__(self, trace_memory=False):
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def collect(self):
+        host_gc.collect()
+
+    def enable(self):
+        host_gc.enable()
+
+    def disable(self):
+        host_gc.disable()
+
+    def mem_alloc(self):
+        if not tracemalloc.is_tracing():
+            return 0
+        return tracemalloc.get_traced_memory()[0]
+
+    def mem_free(self):
+        size = TRACED_HEAP_SIZE if tracemalloc.is_tracing() else HEAP_SIZE
+        return max(0, size - self.mem_alloc())
+
+# FILESYSTEM ---------------------------
+
+class FakeOS:
+    """os replacement that maps CIRCUITPY-absolute paths into a temp root."""
+
+    def __init__(self, root):
+        self.root = root
+        self.sep = '/'
+
+    def path(self, path):
+        if path.startswith('/'):
+            return os.path.join(self.root, path.lstrip('/'))
+        return path
+
+    def listdir(self, path='/'):
+        return os.listdir(self.path(path))
+
+    def stat(self, path):
+        return tuple(os.stat(self.path(path)))
+
+    def remove(self, path):
+        os.remove(self.path(path))
+
+    def rename(self, old, new):
+        os.replace(self.path(old), self.path(new))
+
+    def mkdir(self, path):
+        os.mkdir(self.path(path))
+
+    def rmdir(self, path):
+        os.rmdir(self.path(path))
+
+    def sync(self):
+        pass
+
+    def uname(self):
+        return ('rp2040', 'sim', '9.0.0', 'simulator', 'Adafruit Macropad RP2040 (simulated)')
+
+    def getenv(self, key, default=None):
+        return default
+
+# SIMULATOR ----------------------------
+
+def parse_script(text):
+    """Parse script text into a time-sorted list of (time, action, arg)."""
+    events = []
+    for line in text.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        parts = line.split(None, 2)
+        when = float(parts[0])
+        action = parts[1]
+        arg = parts[2] if len(parts) > 2 else None
+        if action == 'tap':
+            events.append((when, 'press', int(arg)))
+            events.append((when + 0.05, 'release', int(arg)))
+        elif action == 'click':
+            events.append((when, 'switch', True))
+            events.append((when + 0.05, 'switch', False))
+        elif action in ('press', 'release', 'turn'):
+            events.append((when, action, int(arg)))
+        elif action == 'app':
+            events.append((when, action, arg))
+        else:
+            raise ValueError('Unknown script action: ' + action)
+    events.sort(key=lambda e: e[0])
+    return events
+
+class Simulator:
+    """Runs code.py against fake hardware while replaying a script."""
+
+    def __init__(self, script=(), settle=0.5, code_path=None, macro_dir=None,
+                 trace_memory=False, root=None):
+        self.script = list(script)
+        self.trace_memory = trace_memory
+        self.settle = settle
+        self.code_path = code_path or os.path.join(REPO_ROOT, 'code.py')
+        self.macro_dir = macro_dir or os.path.join(REPO_ROOT, 'macros')
+        self.clock = Clock()
+        self.recorder = HIDRecorder(self.clock)
+        self.encoder_position = 0
+        self.switch_value = False
+        self.pending_keys = []
+        self.key_log = []  # (delivered, key_number, pressed, scripted) per key event
+        self.macropad = None
+        self.namespace = None
+        self.root = root  # Simulated CIRCUITPY drive; a temp dir unless given
+        self._temp_root = root is None
+        self.boot_time = None  # Seconds until the main loop first polled the keys
+        self._end_time = None
+
+    # Script playback, driven by polling from code.py
+
+    def _advance(self):
+        now = self.clock.now()
+        while self.script and self.script[0][0] <= now:
+            when, action, arg = self.script.pop(0)
+            if action in ('press', 'release'):
+                self.pending_keys.append(Event(arg, action == 'press', when))
+            elif action == 'turn':
+                self.encoder_position += arg
+            elif action == 'switch':
+                self.switch_value = arg
+            elif action == 'app':
+                self._jump_to_app(arg)
+        if not self.script and not self.pending_keys:
+            if self._end_time is None:
+                self._end_time = now + self.settle
+            elif now >= self._end_time:
+                raise SimulationComplete()
+
+    def next_key_event(self):
+        if self.boot_time is None:
+            self.boot_time = self.clock.now()
+        self._advance()
+        if self.pending_keys:
+            event = self.pending_keys.pop(0)
+            self.key_log.append((self.clock.now(), event.key_number, event.pressed,
+                                 event.timestamp))
+            return event
+        return None
+
+    def encoder_switch_state(self):
+        self._advance()
+        return self.switch_value
+
+    def _jump_to_app(self, name):
+        ns = self.namespace
+        for app in iter_apps(ns):
+            if name in (app.name, app.folder + '/' + app.filename):
+                ns['current_app'] = app
+                app.switch()
+                return
+        raise ValueError('No app named ' + repr(name))
+
+    # Sandbox setup
+
+    def _make_root(self):
+        if self.root is None:
+            self.root = tempfile.mkdtemp(prefix='circuitpy-')
+        if not os.path.exists(os.path.join(self.root, 'macros')):
+            shutil.copytree(self.macro_dir, os.path.join(self.root, 'macros'))
+
+    def _install_modules(self):
+        mods = sys.modules
+        mods.setdefault('micropython', _module('micropython', const=lambda x: x))
+        mods.setdefault('usb_hid', _module('usb_hid', Device=type('Device', (), {}), devices=()))
+        mods['displayio'] = _module('displayio', Group=Group)
+        mods['terminalio'] = _module('terminalio', FONT=object())
+        mods['adafruit_display_shapes'] = _module('adafruit_display_shapes')
+        mods['adafruit_display_shapes.rect'] = _module('adafruit_display_shapes.rect', Rect=Rect)
+        mods['adafruit_display_text'] = _module('adafruit_display_text')
+        label = _module('adafruit_display_text.label', Label=Label)
+        mods['adafruit_display_text.label'] = label
+        mods['adafruit_display_text'].label = label
+        sim = self
+        mods['adafruit_macropad'] = _module('adafruit_macropad',
+                                            MacroPad=lambda *a, **k: FakeMacroPad(sim))
+        mods['supervisor'] = _module('supervisor', ticks_ms=lambda: int(time.monotonic() * 1000) & 0x1FFFFFFF,
+                                     runtime=_module('runtime', usb_connected=True,
+                                                     serial_bytes_available=0))
+        # Drop macro modules left behind by a previous run
+        for name in [n for n in mods if n.startswith('/')]:
+            del mods[name]
+
+    def _builtins(self):
+        fake_os = FakeOS(self.root)
+        fake_gc = FakeGC(self.trace_memory)
+        real_import = builtins.__import__
+        real_open = builtins.open
+
+        def sim_import(name, globals=None, locals=None, fromlist=(), level=0):
+            if name == 'os':
+                return fake_os
+            if name == 'gc':
+                return fake_gc
+            if name.startswith('/'):
+                return load_path_module(name)
+            return real_import(name, globals, locals, fromlist, level)
+
+        def load_path_module(name):
+            if name in sys.modules:
+                return sys.modules[name]
+            # Same search order as the device: source first, then bytecode
+            path = fake_os.path(name + '.py')
+            if os.path.exists(path):
+                module = types.ModuleType(name)
+                module.__file__ = path
+                sys.modules[name] = module
+                try:
+                    with real_open(path) as f:
+                        source = f.read()
+                    exec(compile(source, path, 'exec'), module.__dict__)
+                except BaseException:
+                    del sys.modules[name]
+                    raise
+                return module
+            if os.path.exists(fake_os.path(name + '.mpy')):
+                raise ImportError(name + ".mpy is MicroPython bytecode, which the host can't run")
+            raise ImportError('no module named ' + repr(name))
+
+        def sim_open(file, mode='r', *args, **kwargs):
+            if isinstance(file, str):
+                file = fake_os.path(file)
+            return real_open(file, mode, *args, **kwargs)
+
+        table = dict(builtins.__dict__)
+        table['__import__'] = sim_import
+        table['open'] = sim_open
+        return table
+
+    def run(self):
+        """Run code.py until the script is exhausted. Returns self."""
+        self._make_root()
+        self._install_modules()
+        self.namespace = {'__name__': '__main__', '__file__': self.code_path,
+                          '__builtins__': self._builtins()}
+        with open(self.code_path) as f:
+            code = compile(f.read(), self.code_path, 'exec')
+        self.clock = self.recorder.clock = Clock()
+        try:
+            exec(code, self.namespace)
+        except SimulationComplete:
+            pass
+        return self
+
+    def cleanup(self):
+        if self.root and self._temp_root:
+            shutil.rmtree(self.root, ignore_errors=True)
+            self.root = None
+
+    # Results
+
+    def reports(self, device=None):
+        return [r for r in self.recorder.reports if device is None or r[1] == device]
+
+    def dispatch_latencies(self):
+        """Seconds from each scripted key press to its first HID report.
+
+        Timed from the scripted press rather than from code.py polling the
+        event, so time the event spent waiting (e.g. while the main loop
+        backs off when idle) counts. Presses that produced no report before
+        the next key event was delivered are skipped.
+        """
+        latencies = []
+        reports = self.recorder.reports
+        for i, (delivered, _, pressed, scripted) in enumerate(self.key_log):
+            if not pressed:
+                continue
+            limit = self.key_log[i + 1][0] if i + 1 < len(self.key_log) else float('inf')
+            for sent, _, _ in reports:
+                if delivered <= sent < limit:
+                    latencies.append(sent - scripted)
+                    break
+        return latencies
+
+    def summary(self):
+        return {
+            'duration': self.clock.now(),
+            'boot_time': self.boot_time,
+            'key_events': len(self.key_log),
+            'hid_reports': len(self.recorder.reports),
+            'display_refreshes': self.macropad.display.refreshes if self.macropad else 0,
+            'pixel_shows': self.macropad.pixels.shows if self.macropad else 0,
+            'reports': [(round(t, 4), dev, report.hex()) for t, dev, report in self.recorder.reports],
+        }
+
+def iter_apps(namespace):
+    """Yield every App object the running program knows about."""
+    return namespace['all_apps'](namespace['apps'])
+
+def all_apps_script(namespace, gap=0.3):
+    """Build a script that visits every app and taps each labelled key."""
+    lines = []
+    t = 0.2
+    for app in iter_apps(namespace):
+        app.load()
+        lines.append('%.3f app %s/%s' % (t, app.folder, app.filename))
+        t += gap
+        for key in range(min(12, len(app.macros))):
+            if app.macros[key][1]:
+                lines.append('%.3f tap %d' % (t, key))
+                t += gap
+    return '\n'.join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--script', help='event script file (default: none)')
+    parser.add_argument('--all-apps', action='store_true',
+                        help='visit every app in macros/ and tap each labelled key')
+    parser.add_argument('--settle', type=float, default=0.5,
+                        help='seconds to keep running after the last event')
+    parser.add_argument('--json', help='write recorded reports and counters to FILE')
+    args = parser.parse_args()
+
+    script = []
+    if args.script:
+        with open(args.script) as f:
+            script = parse_script(f.read())
+    if args.all_apps:
+        probe = Simulator(settle=0).run()
+        script = parse_script(all_apps_script(probe.namespace))
+        probe.cleanup()
+
+    sim = Simulator(script, settle=args.settle).run()
+    result = sim.summary()
+    result['dispatch_latencies'] = sim.dispatch_latencies()
+    sim.cleanup()
+    print('%d key events, %d HID reports, %d display refreshes, %d pixel shows in %.2f s' % (
+        result['key_events'], result['hid_reports'], result['display_refreshes'],
+        result['pixel_shows'], result['duration']))
+    latencies = result['dispatch_latencies']
+    if latencies:
+        print('press to first report: mean %.2f ms, max %.2f ms over %d presses' % (
+            sum(latencies) * 1000 / len(latencies), max(latencies) * 1000, len(latencies)))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=1)
+
+if __name__ == '__main__':
+    main()